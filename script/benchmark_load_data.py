@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "fhirclient",
+# ]
+# ///
+# coding: utf-8
+
+"""
+Benchmark the bundle processing steps of load_data.py
+
+Times the reference rewriting done before a bundle is uploaded, comparing the
+previous multi-pass approach (a LOINC check over json.dumps of the bundle, a URN
+pass and a search reference pass, copied here from the original load_data.py)
+with the single-pass rewrite_bundle_references.
+No FHIR server is contacted.
+
+Usage:
+    uv run ./script/benchmark_load_data.py [directory] [--repeat N]
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import load_data
+
+
+# Verbatim copies of the multi-pass functions load_data.py had before
+# rewrite_bundle_references replaced them (its process_synthea_bundle and
+# resolve_search_references are now wrappers around the single-pass engine)
+
+
+def analyze_references(entry):
+    """
+    Extract all references from an entry by recursively traversing the object
+
+    Args:
+        entry: The FHIR entry to analyze
+
+    Returns:
+        list: All reference values found in the entry
+    """
+    refs = []
+
+    def extract_refs(obj):
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key == "reference" and isinstance(value, str):
+                    refs.append(value)
+                elif isinstance(value, (dict, list)):
+                    extract_refs(value)
+        elif isinstance(obj, list):
+            for item in obj:
+                extract_refs(item)
+
+    extract_refs(entry)
+    return refs
+
+
+def process_synthea_bundle(bundle_data):
+    """
+    Pre-process a Synthea-generated bundle to fix URN references
+
+    Args:
+        bundle_data (dict): The FHIR bundle to process
+
+    Returns:
+        dict: The processed bundle with fixed references
+    """
+    # Track references that need to be fixed
+    references_map = {}
+
+    # First pass: build a map of fullUrl to resource ID and type
+    for entry in bundle_data.get("entry", []):
+        full_url = entry.get("fullUrl", "")
+        resource = entry.get("resource", {})
+        resource_type = resource.get("resourceType")
+        resource_id = resource.get("id")
+
+        if full_url.startswith("urn:uuid:") and resource_type and resource_id:
+            # Map the URN to a proper reference
+            direct_ref = f"{resource_type}/{resource_id}"
+            references_map[full_url] = direct_ref
+
+    print(f"Found {len(references_map)} URN references to fix")
+
+    # Second pass: fix all references
+    def fix_references(obj):
+        """Recursively update references in an object"""
+        if isinstance(obj, dict):
+            for key, value in list(obj.items()):
+                if key == "reference" and isinstance(value, str):
+                    # Fix URN references
+                    if value in references_map:
+                        obj[key] = references_map[value]
+                elif isinstance(value, (dict, list)):
+                    fix_references(value)
+        elif isinstance(obj, list):
+            for item in obj:
+                fix_references(item)
+
+    # Update all references in the bundle
+    fix_references(bundle_data)
+
+    # Clean up fullUrl fields to avoid confusion
+    for entry in bundle_data.get("entry", []):
+        if "fullUrl" in entry and entry["fullUrl"].startswith("urn:uuid:"):
+            resource = entry.get("resource", {})
+            resource_type = resource.get("resourceType")
+            resource_id = resource.get("id")
+            if resource_type and resource_id:
+                entry["fullUrl"] = f"{resource_type}/{resource_id}"
+
+    return bundle_data
+
+
+def resolve_search_references(bundle_data):
+    """
+    Replace search parameter references with direct references by creating necessary resources
+
+    Args:
+        bundle_data (dict): The FHIR bundle to process
+
+    Returns:
+        tuple: (processed bundle, count of created resources)
+    """
+    # Find all unique search parameter references
+    search_refs = {}  # Map of search ref to created resource
+
+    # Create a map of existing resources by identifier
+    existing_resources = {}
+
+    # First, index existing resources by their identifiers
+    for entry in bundle_data.get("entry", []):
+        resource = entry.get("resource", {})
+        resource_type = resource.get("resourceType")
+        identifiers = resource.get("identifier", [])
+
+        for identifier in identifiers:
+            system = identifier.get("system")
+            value = identifier.get("value")
+            if system and value:
+                key = f"{resource_type}?identifier={system}|{value}"
+                existing_resources[key] = f"{resource_type}/{resource.get('id')}"
+
+    # Find all search parameter references in the bundle
+    for entry in bundle_data.get("entry", []):
+        refs = analyze_references(entry)
+        for ref in refs:
+            if "?" in ref and "identifier=" in ref:
+                # Only process search refs not already in existing resources
+                if ref not in existing_resources and ref not in search_refs:
+                    search_refs[ref] = None
+
+    # Create the missing resources
+    new_entries = []
+    created = 0
+
+    for ref in search_refs:
+        # Parse the reference
+        if "?" not in ref or "identifier=" not in ref:
+            continue
+
+        parts = ref.split("?")
+        resource_type = parts[0]
+
+        # Extract identifier from search parameter
+        identifier_parts = parts[1].split("=")
+        if len(identifier_parts) != 2:
+            continue
+
+        system_value = identifier_parts[1]
+        if "|" not in system_value:
+            continue
+
+        system, value = system_value.split("|", 1)
+
+        # Create a reproducible ID based on the reference
+        hash_input = f"{resource_type}-{system}-{value}"
+        resource_id = hashlib.md5(hash_input.encode("utf-8")).hexdigest()
+
+        # Create basic resource structure based on type
+        if resource_type == "Practitioner":
+            new_resource = {
+                "resourceType": "Practitioner",
+                "id": resource_id,
+                "identifier": [{"system": system, "value": value}],
+                "active": True,
+                "name": [{"family": "Generated", "given": ["Practitioner"]}],
+            }
+        elif resource_type == "Organization":
+            new_resource = {
+                "resourceType": "Organization",
+                "id": resource_id,
+                "identifier": [{"system": system, "value": value}],
+                "active": True,
+                "name": "Generated Organization",
+            }
+        elif resource_type == "Location":
+            new_resource = {
+                "resourceType": "Location",
+                "id": resource_id,
+                "identifier": [{"system": system, "value": value}],
+                "status": "active",
+                "name": "Generated Location",
+            }
+        else:
+            # Skip unsupported resource types
+            print(f"Skipping unsupported resource type: {resource_type}")
+            continue
+
+        # Add the new resource to our new entries list with PUT request
+        new_entries.append(
+            {
+                "resource": new_resource,
+                "request": {"method": "PUT", "url": f"{resource_type}/{resource_id}"},
+            }
+        )
+
+        # Map this search reference to the direct reference
+        direct_ref = f"{resource_type}/{resource_id}"
+        search_refs[ref] = direct_ref
+        created += 1
+
+    # Update all search parameter references in the bundle
+    def update_search_refs(obj):
+        """Update all search parameter references in a nested object"""
+        if isinstance(obj, dict):
+            for key, value in list(obj.items()):
+                if key == "reference" and isinstance(value, str):
+                    # Check if this is a search parameter reference we're resolving
+                    if value in search_refs and search_refs[value] is not None:
+                        obj[key] = search_refs[value]
+                    # Or check if it's a reference to an existing resource
+                    elif value in existing_resources:
+                        obj[key] = existing_resources[value]
+                elif isinstance(value, (dict, list)):
+                    update_search_refs(value)
+        elif isinstance(obj, list):
+            for item in obj:
+                update_search_refs(item)
+
+    # Update all references in the bundle
+    update_search_refs(bundle_data)
+
+    # Add the new entries to the beginning of the bundle
+    # This ensures they're created before they're referenced
+    if new_entries:
+        bundle_data["entry"] = new_entries + bundle_data.get("entry", [])
+
+    return bundle_data, created
+
+
+def multi_pass(bundle_data, loinc_code):
+    """Process a bundle the way process_and_upload_file did before the single-pass engine"""
+    if loinc_code and loinc_code not in json.dumps(bundle_data):
+        raise ValueError(f"Bundle does not contain required LOINC code {loinc_code}")
+    bundle_data = process_synthea_bundle(bundle_data)
+    bundle_data, _ = resolve_search_references(bundle_data)
+    return bundle_data
+
+
+def single_pass(bundle_data, loinc_code):
+    """Process a bundle with rewrite_bundle_references"""
+    bundle_data, stats = load_data.rewrite_bundle_references(
+        bundle_data, loinc_code=loinc_code
+    )
+    if not stats["code_found"]:
+        raise ValueError(f"Bundle does not contain required LOINC code {loinc_code}")
+    return bundle_data
+
+
+def time_step(step, raw, loinc_code, repeat):
+    """
+    Time a processing step on fresh copies of a bundle
+
+    Args:
+        step (callable): The processing function to time
+        raw (str): The bundle JSON text
+        loinc_code (str): Required LOINC code passed to the step
+        repeat (int): Number of timed runs
+
+    Returns:
+        tuple: (list of run times in seconds, processed bundle from the last run)
+    """
+    times = []
+    result = None
+    for _ in range(repeat):
+        bundle_data = json.loads(raw)
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            try:
+                result = step(bundle_data, loinc_code)
+            except ValueError:
+                result = None
+            times.append(time.perf_counter() - start)
+    return times, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory", nargs="?", default="./fhir-data")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--loinc-code", default="55232-3")
+    args = parser.parse_args()
+
+    print(f"{'file':<40} {'size':>8} {'multi-pass':>12} {'single-pass':>12} {'speedup':>8}")
+    for file_path in sorted(Path(args.directory).glob("*.json")):
+        raw = file_path.read_text()
+        before, expected = time_step(multi_pass, raw, args.loinc_code, args.repeat)
+        after, actual = time_step(single_pass, raw, args.loinc_code, args.repeat)
+
+        if expected != actual:
+            print(f"{file_path.name}: single-pass output differs from multi-pass output")
+            sys.exit(1)
+
+        before_ms = statistics.median(before) * 1000
+        after_ms = statistics.median(after) * 1000
+        print(
+            f"{file_path.name[:40]:<40} {len(raw) / 1e6:>6.1f}MB "
+            f"{before_ms:>10.1f}ms {after_ms:>10.1f}ms {before_ms / after_ms:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "fhirclient",
+#     "fhirpathpy~=0.2.2",
+#     "flask",
+#     "pandas~=1.5.3",
+#     "pyjwt[crypto]",
+#     "requests~=2.32.3",
+#     "rich~=13.8.1",
+#     "tqdm~=4.66.5",
+# ]
+# ///
+# coding: utf-8
+
+"""
+Benchmark suite for the FHIR loader and the bulk data helpers
+
+Times importing load_data.py, its bundle processing and upload steps and the NDJSON
+loading, Bulk Data export and DataFrame building of the bulk data helpers on local
+fixtures (fhir-data/*.json and workshops/bulk-data/synthea_10.ndjson, optionally
+scaled up with synthetic_data.py). Uploads and exports go to a local stub FHIR
+server (stub_fhir_server.py), so no external server is needed. Results are
+written as a JSON report that later runs can be compared against.
+
+Usage:
+    uv run ./script/benchmark_suite.py [--patients N] [--repeat N] [--latency SECONDS]
+        [--workers N] [--files-per-type N] [--only NAME ...]
+        [--output report.json] [--compare baseline.json]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from pandas.testing import assert_frame_equal
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+REPO_DIR = SCRIPT_DIR.parent
+
+sys.path.insert(0, str(SCRIPT_DIR))
+sys.path.insert(0, str(REPO_DIR / "workshops" / "bulk-data" / "solutions"))
+
+import helper
+import load_data
+import stub_fhir_server
+import synthetic_data
+
+# FHIRPaths used by the DataFrame benchmarks, taken from the workshop notebooks
+FHIR_PATHS = {
+    "Condition": [
+        ("patient", "subject.reference"),
+        ("code", "code.coding[0].code"),
+        ("code_display", "code.coding[0].display"),
+        ("code_system", "code.coding[0].system"),
+    ],
+    "Observation": [
+        ("patient", "subject.reference"),
+        ("code", "code.coding[0].code"),
+        ("value", "valueQuantity.value"),
+        ("unit", "valueQuantity.unit"),
+        ("category", "category.coding.where(system.contains('observation-category')).code"),
+    ],
+}
+
+
+def bundle_benchmark(function):
+    """Benchmark a function that processes one bundle, on fresh copies of every bundle"""
+
+    def setup(fixtures):
+        texts = [path.read_text() for path in fixtures["bundles"]]
+
+        def run():
+            elapsed = 0.0
+            for text in texts:
+                bundle_data = json.loads(text)
+                start = time.perf_counter()
+                function(bundle_data)
+                elapsed += time.perf_counter() - start
+            return elapsed, sum(len(text) for text in texts)
+
+        return run
+
+    return setup
+
+
+def upload_benchmark(strategy):
+    """Benchmark uploading every bundle to the stub server with an upload strategy"""
+
+    def setup(fixtures):
+        def run():
+            start = time.perf_counter()
+            successes, failures = load_data.run_fhir_upload(
+                fixtures["bundle_dir"],
+                fixtures["base_url"],
+                max_files=len(fixtures["bundles"]),
+                workers=fixtures["workers"],
+                strategy=strategy,
+            )
+            elapsed = time.perf_counter() - start
+            if failures:
+                raise RuntimeError(f"{len(failures)} uploads to the stub server failed")
+            return elapsed, sum(path.stat().st_size for path in fixtures["bundles"])
+
+        return run
+
+    return setup
+
+
+def synthea_fetcher_benchmark(fixtures):
+    def run():
+        start = time.perf_counter()
+        helper.SyntheaDataFetcher(str(fixtures["ndjson"]))
+        return time.perf_counter() - start, fixtures["ndjson"].stat().st_size
+
+    return run
+
+
+def reprocess_dataframes_benchmark(fixtures):
+    fetcher = helper.SyntheaDataFetcher(str(fixtures["ndjson"]))
+    resources = sum(len(fetcher.resources_by_type.get(t, [])) for t in FHIR_PATHS)
+
+    def run():
+        start = time.perf_counter()
+        fetcher.reprocess_dataframes(FHIR_PATHS)
+        return time.perf_counter() - start, resources
+
+    return run
+
+
+def build_dataframes_benchmark(fixtures):
+    """Benchmark flattening every resource in a pool of `workers` processes"""
+    fetcher = helper.SyntheaDataFetcher(str(fixtures["ndjson"]))
+    resources_by_type = fetcher.resources_by_type
+    resources = sum(len(r) for r in resources_by_type.values())
+    workers = max(fixtures["workers"], 2)
+
+    # Chunks built in parallel must give exactly the DataFrames built serially
+    for typed in (False, True):
+        serial = helper.build_dataframes(resources_by_type, {}, typed=typed)
+        parallel = helper.build_dataframes(resources_by_type, {}, workers, typed=typed)
+        for resource_type, df in serial.items():
+            assert_frame_equal(parallel[resource_type], df, check_exact=True)
+
+    def run():
+        start = time.perf_counter()
+        helper.build_dataframes(resources_by_type, {}, workers)
+        return time.perf_counter() - start, resources
+
+    return run
+
+
+def bulk_export_benchmark(fixtures):
+    # The stub server does not verify signatures, so any key will do
+    private_key = (
+        rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        .private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+        .decode()
+    )
+    stats = fixtures["stub_stats"]
+
+    def run():
+        sent_before = stats["bytes_sent"]
+        start = time.perf_counter()
+        fetcher = helper.BulkDataFetcher(
+            fixtures["base_url"], "benchmark-client", private_key, "benchmark-key"
+        )
+        for resource_type, fhir_paths in FHIR_PATHS.items():
+            fetcher.add_resource_type(resource_type, fhir_paths)
+        fetcher.get_dataframes()
+        return time.perf_counter() - start, stats["bytes_sent"] - sent_before
+
+    return run
+
+
+def import_benchmark(module):
+    """Benchmark importing a module in a new interpreter, as a spawned worker process does"""
+
+    def setup(fixtures):
+        # Environment without FHIR_SERVER, to check that importing does not need it
+        env = {key: value for key, value in os.environ.items() if key != "FHIR_SERVER"}
+        command = [sys.executable, "-c", f"import {module}"]
+
+        def run():
+            baseline_start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", "pass"], env=env, check=True, capture_output=True)
+            baseline = time.perf_counter() - baseline_start
+
+            start = time.perf_counter()
+            subprocess.run(command, cwd=SCRIPT_DIR, env=env, check=True, capture_output=True)
+            # Only count the import, not the interpreter start-up
+            return max(time.perf_counter() - start - baseline, 0.0), 1
+
+        return run
+
+    return setup
+
+
+# name: (setup function returning a run function, unit of the work done per run)
+BENCHMARKS = {
+    "import_load_data": (import_benchmark("load_data"), "imports"),
+    "process_synthea_bundle": (bundle_benchmark(load_data.process_synthea_bundle), "bytes"),
+    "resolve_search_references": (
+        bundle_benchmark(load_data.resolve_search_references),
+        "bytes",
+    ),
+    "rewrite_bundle_references": (
+        bundle_benchmark(load_data.rewrite_bundle_references),
+        "bytes",
+    ),
+    "run_fhir_upload": (upload_benchmark("transaction"), "bytes"),
+    "run_fhir_upload_batch": (upload_benchmark("batch"), "bytes"),
+    "run_fhir_upload_import": (upload_benchmark("import"), "bytes"),
+    "synthea_fetcher_load": (synthea_fetcher_benchmark, "bytes"),
+    "reprocess_dataframes": (reprocess_dataframes_benchmark, "resources"),
+    "build_dataframes_parallel": (build_dataframes_benchmark, "resources"),
+    "bulk_export": (bulk_export_benchmark, "bytes"),
+}
+
+
+def prepare_fixtures(work_dir, patients):
+    """
+    Locate the fixtures, scaling them up to `patients` patients if given
+
+    Args:
+        work_dir (Path): Directory for the scaled fixtures
+        patients (int): Number of patients to scale to, or None for the sample data
+
+    Returns:
+        dict: bundle_dir, bundles (list of paths) and ndjson (path)
+    """
+    bundle_dir = REPO_DIR / "fhir-data"
+    ndjson = REPO_DIR / "workshops" / "bulk-data" / "synthea_10.ndjson"
+    if patients:
+        bundle_dir = work_dir / "bundles"
+        synthetic_data.scale_bundles(REPO_DIR / "fhir-data", bundle_dir, patients)
+        scaled = work_dir / "synthea.ndjson"
+        synthetic_data.scale_ndjson(ndjson, scaled, patients)
+        ndjson = scaled
+    return {
+        "bundle_dir": bundle_dir,
+        "bundles": sorted(Path(bundle_dir).glob("*.json")),
+        "ndjson": ndjson,
+    }
+
+
+def run_benchmark(name, fixtures, repeat):
+    """
+    Run one benchmark `repeat` times
+
+    Returns:
+        dict: Median, minimum and maximum seconds, and work per second at the median
+    """
+    setup, unit = BENCHMARKS[name]
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        run = setup(fixtures)
+        times = []
+        for _ in range(repeat):
+            elapsed, work = run()
+            times.append(elapsed)
+
+    median = statistics.median(times)
+    return {
+        "median_s": median,
+        "min_s": min(times),
+        "max_s": max(times),
+        "runs": repeat,
+        "work": work,
+        "unit": unit,
+        "per_second": work / median if median else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    """Print the results, with the change from a baseline report if given"""
+    baseline_results = baseline["results"] if baseline else {}
+    header = f"{'benchmark':<28} {'median':>10} {'min':>10} {'throughput':>18}"
+    if baseline:
+        header += f" {'baseline':>10} {'change':>8}"
+    print(header)
+
+    for name, result in report["results"].items():
+        per_second = result["per_second"] or 0
+        if result["unit"] == "bytes":
+            throughput = f"{per_second / 1e6:.2f} MB/s"
+        else:
+            throughput = f"{per_second:.0f} {result['unit']}/s"
+        line = (
+            f"{name:<28} {result['median_s'] * 1000:>8.1f}ms "
+            f"{result['min_s'] * 1000:>8.1f}ms {throughput:>18}"
+        )
+        if name in baseline_results:
+            before = baseline_results[name]["median_s"]
+            line += f" {before * 1000:>8.1f}ms {(result['median_s'] - before) / before:>+7.1%}"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--patients", type=int, help="Scale the fixtures to this many patients")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0, help="Stub server latency in seconds")
+    parser.add_argument("--workers", type=int, default=4, help="Concurrent uploads")
+    parser.add_argument(
+        "--files-per-type", type=int, default=1, help="Bulk export files per resource type"
+    )
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run")
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    parser.add_argument("--compare", help="Report to compare the results against")
+    args = parser.parse_args()
+
+    baseline = json.loads(Path(args.compare).read_text()) if args.compare else None
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        fixtures = prepare_fixtures(Path(work_dir), args.patients)
+        app = stub_fhir_server.create_app(
+            str(fixtures["ndjson"]),
+            latency=args.latency,
+            files_per_type=args.files_per_type,
+            require_auth=True,
+        )
+        server, fixtures["base_url"] = stub_fhir_server.start_server(app)
+        fixtures["stub_stats"] = app.config["STUB_STATS"]
+        fixtures["workers"] = args.workers
+
+        results = {}
+        try:
+            for name in args.only or BENCHMARKS:
+                print(f"Running {name}...", file=sys.stderr)
+                results[name] = run_benchmark(name, fixtures, args.repeat)
+        finally:
+            server.shutdown()
+
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "git_commit": git_commit(),
+        },
+        "parameters": {
+            "patients": args.patients,
+            "bundles": len(fixtures["bundles"]),
+            "repeat": args.repeat,
+            "latency": args.latency,
+            "workers": args.workers,
+            "files_per_type": args.files_per_type,
+        },
+        "results": results,
+    }
+
+    if baseline and baseline["parameters"] != report["parameters"]:
+        print(f"Note: the baseline was run with different parameters: {baseline['parameters']}")
+    print_report(report, baseline)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
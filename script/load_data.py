@@ -18,38 +18,89 @@ This version uses PUT instead of POST for updating or creating resources to avoi
 """
 
 import re
+import gzip
+import random
+import time
 import uuid
 import json
 import hashlib
-from datetime import datetime
+import sqlite3
+import threading
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-import requests
 import os
 
-# Import FHIR client libraries
-from fhirclient import client, models
-from fhirclient.models.organization import Organization
-from fhirclient.models.location import Location
-from fhirclient.models.practitioner import Practitioner
-from fhirclient.models import bundle as fhir_bundle
+# requests and fhirclient are imported by the functions that talk to the server, so
+# importing the processing functions (e.g. in worker processes) stays fast
 
+# Optional: needed for zstd compressed uploads (compression="zstd")
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-# Load the FHIR server URL from environment variables
-API_BASE = os.environ.get("FHIR_SERVER")
+# Bundle files uploaded by run_fhir_upload; .gz files are decompressed while reading
+BUNDLE_PATTERNS = ("*.json", "*.json.gz")
 
-# Check if the environment variable exists
-if API_BASE is None:
-    raise ValueError("FHIR_SERVER environment variable is not set")
+# Content-Encodings that upload request bodies can be compressed with
+CONTENT_ENCODINGS = ("gzip", "deflate", "zstd")
 
-# Now you can use the FHIR server URL in your script
-print(f"Using FHIR server at: {API_BASE}")
+# Ways run_fhir_upload can send bundles to the server: one transaction per bundle,
+# one batch per bundle (entries succeed or fail independently), or NDJSON files of
+# all processed bundles loaded with the Bulk Data $import operation
+UPLOAD_STRATEGIES = ("transaction", "batch", "import")
 
-# Initialize FHIR client
-settings = {
+# Settings for the FHIR client used to test the server connection
+CLIENT_SETTINGS = {
     "app_id": "my_web_app",
-    "api_base": API_BASE,
 }
-smart = client.FHIRClient(settings=settings)
+
+# FHIR clients by server URL, created on first use (see get_fhir_client)
+_fhir_clients = {}
+_fhir_clients_lock = threading.Lock()
+
+
+def get_api_base():
+    """
+    Get the FHIR server URL from the FHIR_SERVER environment variable
+
+    Returns:
+        str: The FHIR server URL
+
+    Raises:
+        ValueError: If FHIR_SERVER is not set
+    """
+    api_base = os.environ.get("FHIR_SERVER")
+    if api_base is None:
+        raise ValueError("FHIR_SERVER environment variable is not set")
+    return api_base
+
+
+def get_fhir_client(api_base=None):
+    """
+    Get a FHIR client for a server, creating it on first use
+
+    Args:
+        api_base (str): FHIR server URL (defaults to the FHIR_SERVER environment variable)
+
+    Returns:
+        fhirclient.client.FHIRClient: The client for api_base, shared by later calls
+    """
+    from fhirclient import client
+
+    if api_base is None:
+        api_base = get_api_base()
+    with _fhir_clients_lock:
+        if api_base not in _fhir_clients:
+            _fhir_clients[api_base] = client.FHIRClient(
+                settings={**CLIENT_SETTINGS, "api_base": api_base}
+            )
+        return _fhir_clients[api_base]
 
 
 def analyze_references(entry):
@@ -79,60 +130,415 @@ def analyze_references(entry):
     return refs
 
 
-def process_synthea_bundle(bundle_data):
+def build_search_resource(ref):
     """
-    Pre-process a Synthea-generated bundle to fix URN references
+    Build a placeholder resource for an identifier search parameter reference
 
     Args:
-        bundle_data (dict): The FHIR bundle to process
+        ref (str): Search reference such as "Practitioner?identifier=system|value"
 
     Returns:
-        dict: The processed bundle with fixed references
+        dict: The new resource with a reproducible ID, or None if the reference
+            cannot be parsed or its resource type is not supported
     """
-    # Track references that need to be fixed
-    references_map = {}
+    # Parse the reference
+    if "?" not in ref or "identifier=" not in ref:
+        return None
+
+    parts = ref.split("?")
+    resource_type = parts[0]
+
+    # Extract identifier from search parameter
+    identifier_parts = parts[1].split("=")
+    if len(identifier_parts) != 2:
+        return None
+
+    system_value = identifier_parts[1]
+    if "|" not in system_value:
+        return None
+
+    system, value = system_value.split("|", 1)
+
+    # Create a reproducible ID based on the reference
+    hash_input = f"{resource_type}-{system}-{value}"
+    resource_id = hashlib.md5(hash_input.encode("utf-8")).hexdigest()
+
+    # Create basic resource structure based on type
+    if resource_type == "Practitioner":
+        return {
+            "resourceType": "Practitioner",
+            "id": resource_id,
+            "identifier": [{"system": system, "value": value}],
+            "active": True,
+            "name": [{"family": "Generated", "given": ["Practitioner"]}],
+        }
+    elif resource_type == "Organization":
+        return {
+            "resourceType": "Organization",
+            "id": resource_id,
+            "identifier": [{"system": system, "value": value}],
+            "active": True,
+            "name": "Generated Organization",
+        }
+    elif resource_type == "Location":
+        return {
+            "resourceType": "Location",
+            "id": resource_id,
+            "identifier": [{"system": system, "value": value}],
+            "status": "active",
+            "name": "Generated Location",
+        }
+
+    # Skip unsupported resource types
+    print(f"Skipping unsupported resource type: {resource_type}")
+    return None
+
+
+class GeneratedResourceRegistry:
+    """
+    Persistent record of generated Practitioner, Organization and Location resources
+    that are already on a server
+
+    Generated resources have deterministic IDs, so the same ones are created for many
+    patient bundles. The registry is a SQLite database shared by all upload workers and
+    by later runs, keyed by the server's base URL; a generated resource is only sent
+    to a server again if its content changed. Delete the database file when the
+    server's data is reset.
+
+    Upload workers reserve the generated resources their bundle will send (see
+    reserve()), so concurrent bundles don't send the same resource: a bundle that
+    needs a resource an earlier bundle is still sending waits for that upload to
+    finish. Reservations belong to the calling thread, which uploads one bundle at a
+    time, until it calls mark_uploaded(), mark_staged() or release().
+    """
+
+    def __init__(self, path, base_url):
+        self.path = path
+        self.base_url = base_url.rstrip("/")
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS generated_resources "
+            "(server TEXT NOT NULL, reference TEXT NOT NULL, content_hash TEXT NOT NULL, "
+            "uploaded_at TEXT NOT NULL, PRIMARY KEY (server, reference))"
+        )
+        self._connection.commit()
+        self._uploaded = dict(
+            self._connection.execute(
+                "SELECT reference, content_hash FROM generated_resources WHERE server = ?",
+                (self.base_url,),
+            )
+        )
+        # Resources staged for a Bulk Data import of this run
+        self._staged = {}
+        # reference -> (thread, age) of the bundle sending it; a bundle's age is
+        # assigned on its first reservation, and only younger bundles wait for older
+        # ones, so waiting bundles can't deadlock
+        self._in_flight = {}
+        self._ages = {}
+        self._next_age = 0
+
+    @staticmethod
+    def content_hash(resource):
+        """Hash of a resource's content that does not depend on key order"""
+        return hashlib.sha256(
+            json.dumps(resource, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def reserve(self, resource):
+        """
+        Decide whether the calling thread's bundle has to send a generated resource
+
+        If an earlier bundle is sending the resource, this waits until that upload
+        has finished. Bundles that started later than one already sending it send it
+        as well, rather than wait.
+
+        Args:
+            resource (dict): The generated resource
+
+        Returns:
+            bool: False if the resource is already on the server, staged or included
+                in this bundle; True if the bundle has to send it, in which case it is
+                reserved for the bundle
+        """
+        reference = f"{resource['resourceType']}/{resource['id']}"
+        digest = self.content_hash(resource)
+        thread = threading.get_ident()
+
+        with self._released:
+            if thread not in self._ages:
+                self._ages[thread] = self._next_age
+                self._next_age += 1
+            age = self._ages[thread]
+
+            while True:
+                if digest in (self._uploaded.get(reference), self._staged.get(reference)):
+                    return False
+                holder = self._in_flight.get(reference)
+                if holder is None:
+                    self._in_flight[reference] = (thread, age)
+                    return True
+                if holder[0] == thread:
+                    return False
+                if holder[1] > age:
+                    return True
+                self._released.wait()
+
+    def mark_uploaded(self, resources):
+        """Record resources that are now on the server"""
+        rows = [
+            (
+                self.base_url,
+                f"{resource['resourceType']}/{resource['id']}",
+                self.content_hash(resource),
+                datetime.now(timezone.utc).isoformat(),
+            )
+            for resource in resources
+        ]
+        if not rows:
+            return
+        with self._released:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO generated_resources VALUES (?, ?, ?, ?)", rows
+            )
+            self._connection.commit()
+            for _, reference, digest, _ in rows:
+                self._uploaded[reference] = digest
+                self._staged.pop(reference, None)
+                self._in_flight.pop(reference, None)
+            self._released.notify_all()
+
+    def mark_staged(self, resources):
+        """Record resources staged for this run's Bulk Data import, so other bundles leave them out"""
+        with self._released:
+            for resource in resources:
+                reference = f"{resource['resourceType']}/{resource['id']}"
+                self._staged[reference] = self.content_hash(resource)
+                self._in_flight.pop(reference, None)
+            self._released.notify_all()
+
+    def release(self):
+        """Give up the calling thread's remaining reservations, e.g. after a failed upload"""
+        thread = threading.get_ident()
+        with self._released:
+            self._ages.pop(thread, None)
+            for reference, holder in list(self._in_flight.items()):
+                if holder[0] == thread:
+                    del self._in_flight[reference]
+            self._released.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class BundleReferenceRewriter:
+    """
+    Rewrites URN and identifier search parameter references in bundle entries and
+    looks for a required code in their string values
+
+    Entries are first registered with index_entry(), which only reads the top level of
+    each entry, so that visit() can then rewrite the nested contents in a single walk.
+    Search references that no existing resource satisfies are resolved by generating
+    the referenced resource, collected in new_entries in order of first appearance.
+    Once the required code is known to be present, reserve_generated() claims the
+    generated resources in a GeneratedResourceRegistry: the ones already on the
+    server, or that another bundle is sending, stay referenced but are dropped from
+    new_entries; the others are reserved for this bundle (see
+    GeneratedResourceRegistry.reserve).
+    """
+
+    def __init__(self, fix_urns=True, resolve_search=True, loinc_code=None, registry=None):
+        self.fix_urns = fix_urns
+        self.resolve_search = resolve_search
+        self.loinc_code = loinc_code
+        self.code_found = not loinc_code
+        self.registry = registry
+        self.skipped_resources = 0
 
-    # First pass: build a map of fullUrl to resource ID and type
-    for entry in bundle_data.get("entry", []):
-        full_url = entry.get("fullUrl", "")
+        # Map of fullUrl to direct reference
+        self.references_map = {}
+
+        # Map of identifier search reference to the direct reference of an existing resource
+        self.existing_resources = {}
+
+        # Map of unresolved search ref to the direct reference of a created resource
+        self.search_refs = {}
+        self.new_entries = []
+
+        # Search refs seen by visit(..., rewrite=False), in order of first appearance
+        self.pending_search_refs = {}
+
+    @property
+    def rewrites(self):
+        return self.fix_urns or self.resolve_search
+
+    def index_entry(self, entry):
+        """Register an entry's fullUrl and identifiers, and clean up its fullUrl"""
         resource = entry.get("resource", {})
         resource_type = resource.get("resourceType")
         resource_id = resource.get("id")
 
-        if full_url.startswith("urn:uuid:") and resource_type and resource_id:
-            # Map the URN to a proper reference
-            direct_ref = f"{resource_type}/{resource_id}"
-            references_map[full_url] = direct_ref
-
-    print(f"Found {len(references_map)} URN references to fix")
-
-    # Second pass: fix all references
-    def fix_references(obj):
-        """Recursively update references in an object"""
+        if self.fix_urns:
+            full_url = entry.get("fullUrl", "")
+            if full_url.startswith("urn:uuid:") and resource_type and resource_id:
+                direct_ref = f"{resource_type}/{resource_id}"
+                self.references_map[full_url] = direct_ref
+                # Clean up fullUrl fields to avoid confusion
+                entry["fullUrl"] = direct_ref
+
+        if self.resolve_search:
+            for identifier in resource.get("identifier", []):
+                system = identifier.get("system")
+                value = identifier.get("value")
+                if system and value:
+                    key = f"{resource_type}?identifier={system}|{value}"
+                    self.existing_resources[key] = f"{resource_type}/{resource_id}"
+
+    def resolve(self, value):
+        """Return the rewritten form of a single reference value"""
+        value = self.references_map.get(value, value)
+
+        if self.resolve_search and "?" in value and "identifier=" in value:
+            if value in self.existing_resources:
+                return self.existing_resources[value]
+
+            if value not in self.search_refs:
+                new_resource = build_search_resource(value)
+                if new_resource is None:
+                    self.search_refs[value] = None
+                else:
+                    direct_ref = f"{new_resource['resourceType']}/{new_resource['id']}"
+                    self.new_entries.append(
+                        {
+                            "resource": new_resource,
+                            "request": {"method": "PUT", "url": direct_ref},
+                        }
+                    )
+                    self.search_refs[value] = direct_ref
+
+            return self.search_refs[value] or value
+
+        return value
+
+    def resolve_pending(self):
+        """Resolve the search refs collected by visit(..., rewrite=False)"""
+        for value in self.pending_search_refs:
+            self.resolve(value)
+        self.pending_search_refs = {}
+
+    def reserve_generated(self):
+        """Reserve the generated resources, dropping the ones the registry already has"""
+        if self.registry is None:
+            return
+        reserved = []
+        for entry in self.new_entries:
+            if self.registry.reserve(entry["resource"]):
+                reserved.append(entry)
+            else:
+                self.skipped_resources += 1
+        self.new_entries = reserved
+
+    def visit(self, obj, rewrite=True):
+        """
+        Recursively rewrite references and check strings for the required code
+
+        Args:
+            obj: The bundle, entry or nested element to walk
+            rewrite (bool): If False, references are not changed; search references
+                are only collected so they can be resolved with resolve_pending()
+                once every entry has been indexed
+        """
+        loinc_code = self.loinc_code
         if isinstance(obj, dict):
-            for key, value in list(obj.items()):
-                if key == "reference" and isinstance(value, str):
-                    # Fix URN references
-                    if value in references_map:
-                        obj[key] = references_map[value]
+            for key, value in obj.items():
+                if isinstance(value, str):
+                    if not self.code_found and loinc_code in value:
+                        self.code_found = True
+                    if key == "reference" and self.rewrites:
+                        if rewrite:
+                            obj[key] = self.resolve(value)
+                        elif "?" in value and "identifier=" in value:
+                            self.pending_search_refs.setdefault(value, None)
                 elif isinstance(value, (dict, list)):
-                    fix_references(value)
+                    self.visit(value, rewrite)
         elif isinstance(obj, list):
             for item in obj:
-                fix_references(item)
+                if isinstance(item, str):
+                    if not self.code_found and loinc_code in item:
+                        self.code_found = True
+                elif isinstance(item, (dict, list)):
+                    self.visit(item, rewrite)
+
+    def stats(self):
+        return {
+            "urn_references": len(self.references_map),
+            "created_resources": len(self.new_entries),
+            "skipped_resources": self.skipped_resources,
+            "generated_resources": [entry["resource"] for entry in self.new_entries],
+            "code_found": self.code_found,
+        }
+
+
+def rewrite_bundle_references(
+    bundle_data, fix_urns=True, resolve_search=True, loinc_code=None, registry=None
+):
+    """
+    Fix URN references, resolve search parameter references and look for a
+    required code in a single traversal of the bundle
+
+    Only the top level of each entry is read to build the lookup tables, so the
+    nested resource contents are walked exactly once no matter how many of the
+    steps are enabled.
+
+    Args:
+        bundle_data (dict): The FHIR bundle to process
+        fix_urns (bool): Whether to replace urn:uuid references with direct references
+        resolve_search (bool): Whether to replace identifier search references with
+            direct references, creating the referenced resources if necessary
+        loinc_code (str): Code to look for in the bundle's string values
+        registry (GeneratedResourceRegistry): Generated resources already uploaded
+            are referenced without being added to the bundle again
+
+    Returns:
+        tuple: (processed bundle, dict with the number of URN references fixed, the
+            number of created and skipped resources, the generated resources added to
+            the bundle and whether loinc_code was found)
+    """
+    rewriter = BundleReferenceRewriter(fix_urns, resolve_search, loinc_code, registry)
+    entries = bundle_data.get("entry", [])
+
+    for entry in entries:
+        rewriter.index_entry(entry)
 
-    # Update all references in the bundle
-    fix_references(bundle_data)
+    if rewriter.rewrites or not rewriter.code_found:
+        rewriter.visit(bundle_data)
 
-    # Clean up fullUrl fields to avoid confusion
-    for entry in bundle_data.get("entry", []):
-        if "fullUrl" in entry and entry["fullUrl"].startswith("urn:uuid:"):
-            resource = entry.get("resource", {})
-            resource_type = resource.get("resourceType")
-            resource_id = resource.get("id")
-            if resource_type and resource_id:
-                entry["fullUrl"] = f"{resource_type}/{resource_id}"
+    # A bundle without the required code is skipped, so it must not hold reservations
+    if rewriter.code_found:
+        rewriter.reserve_generated()
 
+    # Add the new entries to the beginning of the bundle
+    # This ensures they're created before they're referenced
+    if rewriter.new_entries:
+        bundle_data["entry"] = rewriter.new_entries + entries
+
+    return bundle_data, rewriter.stats()
+
+
+def process_synthea_bundle(bundle_data):
+    """
+    Pre-process a Synthea-generated bundle to fix URN references
+
+    Args:
+        bundle_data (dict): The FHIR bundle to process
+
+    Returns:
+        dict: The processed bundle with fixed references
+    """
+    bundle_data, stats = rewrite_bundle_references(bundle_data, resolve_search=False)
+    print(f"Found {stats['urn_references']} URN references to fix")
     return bundle_data
 
 
@@ -146,131 +552,1541 @@ def resolve_search_references(bundle_data):
     Returns:
         tuple: (processed bundle, count of created resources)
     """
-    # Find all unique search parameter references
-    search_refs = {}  # Map of search ref to created resource
+    bundle_data, stats = rewrite_bundle_references(bundle_data, fix_urns=False)
+    return bundle_data, stats["created_resources"]
+
+
+def open_bundle(file_path):
+    """
+    Open a bundle file as text, decompressing it if its name ends in .gz
+
+    Args:
+        file_path (Path): Path to a .json or .json.gz file
+
+    Returns:
+        file object: The open text file
+    """
+    if str(file_path).endswith(".gz"):
+        return gzip.open(file_path, "rt", encoding="utf-8")
+    return open(file_path, "r", encoding="utf-8")
 
-    # Create a map of existing resources by identifier
-    existing_resources = {}
 
-    # First, index existing resources by their identifiers
-    for entry in bundle_data.get("entry", []):
+def check_compression(compression):
+    """
+    Check that request bodies can be compressed with a Content-Encoding
+
+    Args:
+        compression (str): "gzip", "deflate", "zstd" or None for no compression
+
+    Raises:
+        ValueError: If the encoding is unknown, or zstd without the zstandard package
+    """
+    if compression is not None and compression not in CONTENT_ENCODINGS:
+        raise ValueError(
+            f"Unsupported compression {compression!r}; use one of {', '.join(CONTENT_ENCODINGS)}"
+        )
+    if compression == "zstd" and zstandard is None:
+        raise ValueError("zstd compression needs the zstandard package")
+
+
+def compress_chunks(chunks, compression):
+    """
+    Compress a request body for a Content-Encoding as it is generated
+
+    Args:
+        chunks (iterable): The body as chunks of bytes
+        compression (str): "gzip", "deflate" (zlib format, as HTTP defines it) or "zstd"
+
+    Yields:
+        bytes: Chunks of the compressed body
+    """
+    check_compression(compression)
+    if compression == "zstd":
+        compressor = zstandard.ZstdCompressor().compressobj()
+    else:
+        compressor = zlib.compressobj(wbits=31 if compression == "gzip" else 15)
+
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def iter_bundle_items(file_path, chunk_size=1 << 20):
+    """
+    Incrementally parse a bundle file without loading the whole document
+
+    Args:
+        file_path (Path): Path to the FHIR JSON bundle (.json or .json.gz)
+        chunk_size (int): Number of characters read from the file at a time
+
+    Yields:
+        tuple: ("entry", entry) for each element of the top-level "entry" array, and
+            (key, value) for every other top-level member, in document order
+
+    Raises:
+        ValueError: If the file is not a JSON object, is truncated or has data after
+            the object
+    """
+    decoder = json.JSONDecoder()
+
+    with open_bundle(file_path) as file:
+        buffer = ""
+        pos = 0
+        eof = False
+
+        def fill(min_chars=1):
+            """Read more of the file until min_chars are available after pos"""
+            nonlocal buffer, pos, eof
+            while len(buffer) - pos < min_chars and not eof:
+                chunk = file.read(chunk_size)
+                if not chunk:
+                    eof = True
+                    break
+                buffer = buffer[pos:] + chunk
+                pos = 0
+
+        def next_char():
+            """Skip whitespace and return the next character without consuming it"""
+            nonlocal pos
+            while True:
+                fill()
+                while pos < len(buffer) and buffer[pos] in " \t\r\n":
+                    pos += 1
+                if pos < len(buffer):
+                    return buffer[pos]
+                if eof:
+                    raise ValueError(f"Invalid JSON in file: unexpected end of {file_path}")
+
+        def expect(chars):
+            nonlocal pos
+            char = next_char()
+            if char not in chars:
+                raise ValueError(f"Invalid JSON in file: expected {chars!r} but found {char!r}")
+            pos += 1
+            return char
+
+        def decode_value():
+            """Decode the next complete JSON value, reading more text as needed"""
+            nonlocal pos
+            number = next_char() in "-0123456789"
+            want = chunk_size
+            while True:
+                if number:
+                    # A number running to the end of the buffer may continue in the
+                    # next chunk, so only decode it once a character follows it
+                    end = pos
+                    while end < len(buffer) and buffer[end] in "+-.0123456789eE":
+                        end += 1
+                    complete = end < len(buffer) or eof
+                else:
+                    complete = True
+                if complete:
+                    try:
+                        value, pos = decoder.raw_decode(buffer, pos)
+                        return value
+                    except json.JSONDecodeError as e:
+                        if eof:
+                            raise ValueError(f"Invalid JSON in file: {str(e)}")
+                fill(len(buffer) - pos + want)
+                want *= 2
+
+        def expect_end():
+            """Make sure only whitespace follows the bundle"""
+            try:
+                char = next_char()
+            except ValueError:
+                return
+            raise ValueError(f"Invalid JSON in file: unexpected {char!r} after the bundle")
+
+        expect("{")
+        if next_char() == "}":
+            pos += 1
+            expect_end()
+            return
+        while True:
+            key = decode_value()
+            expect(":")
+            if key == "entry" and next_char() == "[":
+                expect("[")
+                if next_char() == "]":
+                    pos += 1
+                else:
+                    while True:
+                        yield "entry", decode_value()
+                        if expect(",]") == "]":
+                            break
+            else:
+                yield key, decode_value()
+            if expect(",}") == "}":
+                expect_end()
+                return
+
+
+def ensure_put_request(entry):
+    """Make sure an entry has a request section with PUT method and proper URL"""
+    if "request" not in entry or entry["request"].get("method") != "PUT":
+        resource = entry["resource"]
+        resource_type = resource["resourceType"]
+        resource_id = resource["id"]
+
+        # Update to use PUT with resource ID in URL
+        entry["request"] = {
+            "method": "PUT",
+            "url": f"{resource_type}/{resource_id}",
+        }
+    return entry
+
+
+def stream_process_bundle(
+    file_path, fix_references=True, loinc_code="55232-3", registry=None
+):
+    """
+    Process a bundle file entry by entry, keeping only one entry in memory at a time
+
+    The file is read twice. The first pass indexes fullUrls and identifiers, collects
+    search parameter references and checks for the required LOINC code. The second
+    pass, run each time the returned body generator is called, rewrites every entry
+    and serializes it straight into the request body. The body is identical to
+    serializing the bundle processed by rewrite_bundle_references.
+
+    Args:
+        file_path (Path): Path to the FHIR JSON file
+        fix_references (bool): Whether to fix references in the bundle
+        loinc_code (str): Required LOINC code (skip files without this code)
+        registry (GeneratedResourceRegistry): Generated resources already uploaded
+            are referenced without being added to the bundle again
+
+    Returns:
+        tuple: (function returning a generator of request body chunks as bytes,
+            stats dict as returned by rewrite_bundle_references, plus the number of
+            entries in the processed bundle)
+    """
+    rewriter = BundleReferenceRewriter(
+        fix_references, fix_references, loinc_code, registry
+    )
+
+    # Top-level members in document order; entries are represented by ("entry", None)
+    # and read from the file again when the body is generated
+    members = []
+
+    entry_count = 0
+    for key, value in iter_bundle_items(file_path):
+        if key == "entry":
+            entry_count += 1
+            rewriter.index_entry(value)
+            rewriter.visit(value, rewrite=False)
+            if ("entry", None) not in members:
+                members.append(("entry", None))
+        else:
+            rewriter.visit(value, rewrite=False)
+            members.append((key, value))
+
+    if not rewriter.code_found:
+        return None, rewriter.stats()
+
+    rewriter.resolve_pending()
+    rewriter.reserve_generated()
+
+    # New entries are added to the beginning of the entry array, creating it if needed
+    if rewriter.new_entries and ("entry", None) not in members:
+        members.append(("entry", None))
+
+    def body(chunk_size=1 << 16):
+        """Yield the processed bundle as UTF-8 JSON in chunks of about chunk_size bytes"""
+        chunk = bytearray()
+        for part in body_parts():
+            chunk += part
+            if len(chunk) >= chunk_size:
+                yield bytes(chunk)
+                chunk.clear()
+        if chunk:
+            yield bytes(chunk)
+
+    def body_parts():
+        """Yield the processed bundle as UTF-8 JSON, one entry at a time"""
+        yield b"{"
+        for i, (key, value) in enumerate(members):
+            if i:
+                yield b", "
+
+            if key != "entry":
+                rewriter.visit(value)
+                yield f"{json.dumps(key)}: {json.dumps(value)}".encode("utf-8")
+                continue
+
+            yield b'"entry": ['
+            separator = b""
+            for entry in rewriter.new_entries:
+                yield separator + json.dumps(ensure_put_request(entry)).encode("utf-8")
+                separator = b", "
+
+            for item_key, entry in iter_bundle_items(file_path):
+                if item_key != "entry":
+                    continue
+                rewriter.index_entry(entry)
+                rewriter.visit(entry)
+                yield separator + json.dumps(ensure_put_request(entry)).encode("utf-8")
+                separator = b", "
+            yield b"]"
+        yield b"}"
+
+    stats = rewriter.stats()
+    stats["entries"] = entry_count + len(rewriter.new_entries)
+    return body, stats
+
+
+def split_transaction(bundle_data, max_entries=None, max_bytes=None):
+    """
+    Split a processed transaction bundle into smaller transactions ordered by references
+
+    Entries are grouped using the reference graph from analyze_references: entries
+    that reference each other in a cycle always stay in the same transaction, and
+    every transaction only references resources in itself or in earlier levels.
+
+    Args:
+        bundle_data (dict): The processed FHIR transaction bundle
+        max_entries (int): Maximum number of entries per transaction
+        max_bytes (int): Maximum serialized size of the entries in a transaction
+
+    Returns:
+        list: Levels of transaction bundles. Levels must be uploaded in order, but the
+            bundles within a level are independent and can be uploaded in parallel.
+            A cycle larger than the limits is kept whole in one oversized bundle.
+    """
+    entries = bundle_data.get("entry", [])
+
+    # Map direct references to the entries that define them
+    positions = {}
+    for i, entry in enumerate(entries):
         resource = entry.get("resource", {})
-        resource_type = resource.get("resourceType")
-        identifiers = resource.get("identifier", [])
-
-        for identifier in identifiers:
-            system = identifier.get("system")
-            value = identifier.get("value")
-            if system and value:
-                key = f"{resource_type}?identifier={system}|{value}"
-                existing_resources[key] = f"{resource_type}/{resource.get('id')}"
-
-    # Find all search parameter references in the bundle
-    for entry in bundle_data.get("entry", []):
-        refs = analyze_references(entry)
-        for ref in refs:
-            if "?" in ref and "identifier=" in ref:
-                # Only process search refs not already in existing resources
-                if ref not in existing_resources and ref not in search_refs:
-                    search_refs[ref] = None
-
-    # Create the missing resources
-    new_entries = []
-    created = 0
-
-    for ref in search_refs:
-        # Parse the reference
-        if "?" not in ref or "identifier=" not in ref:
+        positions[f"{resource.get('resourceType')}/{resource.get('id')}"] = i
+
+    dependencies = [
+        {positions[ref] for ref in analyze_references(entry) if ref in positions} - {i}
+        for i, entry in enumerate(entries)
+    ]
+
+    # Tarjan's algorithm (iterative) for the strongly connected components. Components
+    # are emitted only after every component they depend on.
+    index_of = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    counter = 0
+
+    for root in range(len(entries)):
+        if root in index_of:
             continue
+        work = [(root, iter(dependencies[root]))]
+        index_of[root] = lowlink[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index_of:
+                    index_of[child] = lowlink[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(dependencies[child])))
+                    break
+                if child in on_stack:
+                    lowlink[node] = min(lowlink[node], index_of[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index_of[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+
+    # Level of each component: one more than the deepest component it depends on
+    component_of = {}
+    levels = {}
+    for number, component in enumerate(components):
+        for member in component:
+            component_of[member] = number
+        deps = {component_of[d] for m in component for d in dependencies[m]} - {number}
+        levels[number] = 1 + max((levels[d] for d in deps), default=-1)
+
+    by_level = {}
+    for number, component in enumerate(components):
+        by_level.setdefault(levels[number], []).append(component)
+
+    # Pack the components of each level into bundles, keeping bundle order stable
+    split = []
+    for level in sorted(by_level):
+        bundles = []
+        current, current_bytes = [], 0
+        for component in sorted(by_level[level]):
+            size = (
+                sum(len(json.dumps(entries[m])) for m in component) if max_bytes else 0
+            )
+            too_many = max_entries and len(current) + len(component) > max_entries
+            too_big = max_bytes and current_bytes + size > max_bytes
+            if current and (too_many or too_big):
+                bundles.append(current)
+                current, current_bytes = [], 0
+            current.extend(component)
+            current_bytes += size
+        if current:
+            bundles.append(current)
+
+        split.append(
+            [
+                {
+                    "resourceType": "Bundle",
+                    "type": "transaction",
+                    "entry": [entries[m] for m in sorted(members)],
+                }
+                for members in bundles
+            ]
+        )
 
-        parts = ref.split("?")
-        resource_type = parts[0]
+    return split
 
-        # Extract identifier from search parameter
-        identifier_parts = parts[1].split("=")
-        if len(identifier_parts) != 2:
-            continue
 
-        system_value = identifier_parts[1]
-        if "|" not in system_value:
-            continue
+# Status codes the server uses to shed load; uploads pause and retry on these
+BACKPRESSURE_STATUS_CODES = (429, 503)
+# Transient server errors; bundles only contain PUT entries, so resending is safe
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header value
+
+    Args:
+        value (str): Either a number of seconds or an HTTP date
+
+    Returns:
+        float: Seconds to wait, or None if the value is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of sending a request while the upload circuit breaker is open"""
+
+
+class UploadThrottle:
+    """
+    Shared pause gate that stops all upload workers while the server sheds load
+
+    When any upload is answered with 429 or 503, every worker waits until the
+    server's Retry-After has passed (or an exponentially growing default delay
+    if the header is missing) before sending its next request.
+
+    The throttle is also a circuit breaker: when at least failure_threshold of
+    the last `window` requests failed with a transient error, the circuit opens
+    for `cooldown` seconds, during which uploads fail fast with CircuitOpenError
+    instead of waiting. After that a single probe request is let through (other
+    requests still fail fast); if it succeeds uploads resume, otherwise the
+    cooldown doubles.
+    """
+
+    def __init__(
+        self,
+        initial_delay=2.0,
+        max_delay=120.0,
+        failure_threshold=0.5,
+        window=20,
+        min_requests=5,
+        cooldown=30.0,
+    ):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.failure_threshold = failure_threshold
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+        self._delay = initial_delay
+        self._outcomes = deque(maxlen=window)
+        self._cooldown = cooldown
+        self._half_open = False
+        self._probe_in_flight = False
+
+    def wait(self):
+        """
+        Block until uploads are allowed again after a back-off
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with a probe in flight
+        """
+        while True:
+            with self._lock:
+                remaining = self._resume_at - time.monotonic()
+                if self._half_open:
+                    if remaining > 0:
+                        raise CircuitOpenError(
+                            f"Too many failed uploads; not uploading for another {remaining:.0f}s"
+                        )
+                    if self._probe_in_flight:
+                        raise CircuitOpenError("Too many failed uploads; waiting for a probe upload")
+                    # The circuit is half-open: only one request probes the server
+                    self._probe_in_flight = True
+                    return
+                if remaining <= 0:
+                    return
+            time.sleep(remaining)
+
+    def back_off(self, retry_after=None):
+        """
+        Pause all workers after the server asked us to slow down
+
+        Args:
+            retry_after (str): Retry-After header value from the response, if any
+
+        Returns:
+            float: Number of seconds uploads are paused for
+        """
+        delay = parse_retry_after(retry_after)
+        with self._lock:
+            if delay is None:
+                delay = self._delay
+                self._delay = min(self._delay * 2, self.max_delay)
+            delay = min(delay, self.max_delay)
+            self._resume_at = max(self._resume_at, time.monotonic() + delay)
+        return delay
+
+    def record_success(self):
+        """Reset the default back-off delay and close the circuit after a response"""
+        with self._lock:
+            self._delay = self.initial_delay
+            self._outcomes.append(True)
+            if self._half_open:
+                self._half_open = False
+                self._probe_in_flight = False
+                self._cooldown = self.cooldown
+
+    def record_failure(self):
+        """
+        Record a transient failure, opening the circuit if too many requests fail
+
+        Returns:
+            float: Number of seconds uploads fail fast for if the circuit opened,
+                otherwise None
+        """
+        with self._lock:
+            self._outcomes.append(False)
+            if self._half_open:
+                # The probe failed: stay open for longer
+                self._probe_in_flight = False
+                self._cooldown = min(self._cooldown * 2, self.max_delay)
+            elif len(self._outcomes) < self.min_requests or (
+                self._outcomes.count(False) / len(self._outcomes) < self.failure_threshold
+            ):
+                return None
+
+            self._half_open = True
+            self._outcomes.clear()
+            self._resume_at = max(self._resume_at, time.monotonic() + self._cooldown)
+            return self._cooldown
+
+
+def retry_delay(attempt, base_delay=1.0, max_delay=60.0):
+    """
+    Exponential back-off delay with full jitter
+
+    Args:
+        attempt (int): Number of the attempt that just failed, starting at 1
+        base_delay (float): Upper bound of the delay after the first attempt
+        max_delay (float): Largest possible delay
+
+    Returns:
+        float: Seconds to wait before the next attempt
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+def create_upload_session(workers=1):
+    """
+    Create an HTTP session whose connection pool can serve every upload worker
+
+    Args:
+        workers (int): Number of threads that will share the session; when bundles are
+            split, every split transaction uploaded at once counts as a thread
+
+    Returns:
+        requests.Session: Session with a connection pool of at least `workers` connections
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def post_bundle(
+    base_url,
+    make_payload,
+    session=None,
+    throttle=None,
+    max_attempts=5,
+    label="",
+    content_encoding=None,
+    prefer="return=minimal",
+):
+    """
+    POST a bundle to the FHIR server, retrying transient failures
+
+    Request errors (timeouts, connection errors, broken responses) and 429/5xx
+    responses are retried up to max_attempts times, waiting for the response's
+    Retry-After or an exponential back-off with jitter. Retrying is safe because every bundle entry is an idempotent PUT.
+
+    Args:
+        base_url (str): Base URL of the FHIR server
+        make_payload (callable): Returns the keyword arguments carrying the request body
+            (json= or data=); called again for each attempt
+        session (requests.Session): Session to upload with (a new connection is used if None)
+        throttle (UploadThrottle): Shared throttle; when given, 429/503 responses
+            pause all workers, and a high rate of failures makes uploads fail fast
+        max_attempts (int): Maximum number of attempts
+        label (str): Name of the bundle used in log messages
+        content_encoding (str): Content-Encoding of the body, if it is compressed
+        prefer (str): Prefer header of the request
+
+    Returns:
+        requests.Response: The final response
+
+    Raises:
+        requests.exceptions.HTTPError: If the final response is an error
+        requests.exceptions.RequestException: If the final attempt got no response
+        CircuitOpenError: If the throttle's circuit breaker is open
+    """
+    import requests
+
+    headers = {
+        "Content-Type": "application/fhir+json",
+        "Accept": "application/fhir+json",
+        "Prefer": prefer,  # return=minimal minimizes the response size
+    }
+    if content_encoding is not None:
+        headers["Content-Encoding"] = content_encoding
+
+    http = session if session is not None else requests
+
+    for attempt in range(1, max_attempts + 1):
+        if throttle is not None:
+            throttle.wait()
+
+        try:
+            response = http.post(
+                base_url,
+                headers=headers,
+                timeout=300,  # 5 minutes timeout for large bundles
+                **make_payload(),
+            )
+            error = None
+            transient = response.status_code in RETRY_STATUS_CODES
+        except requests.exceptions.RequestException as e:
+            response = None
+            error = e
+            transient = True
+        except BaseException:
+            # Anything else (e.g. an error reading the request body) ends the upload,
+            # but must still settle the outcome so a half-open probe isn't left in flight
+            if throttle is not None:
+                throttle.record_failure()
+            raise
+
+        if throttle is not None:
+            if not transient:
+                throttle.record_success()
+            else:
+                cooldown = throttle.record_failure()
+                if cooldown is not None:
+                    print(f"Too many failed uploads, failing uploads for {cooldown:.1f}s")
+
+        if not transient or attempt == max_attempts:
+            break
 
-        system, value = system_value.split("|", 1)
-
-        # Create a reproducible ID based on the reference
-        hash_input = f"{resource_type}-{system}-{value}"
-        resource_id = hashlib.md5(hash_input.encode("utf-8")).hexdigest()
-
-        # Create basic resource structure based on type
-        if resource_type == "Practitioner":
-            new_resource = {
-                "resourceType": "Practitioner",
-                "id": resource_id,
-                "identifier": [{"system": system, "value": value}],
-                "active": True,
-                "name": [{"family": "Generated", "given": ["Practitioner"]}],
-            }
-        elif resource_type == "Organization":
-            new_resource = {
-                "resourceType": "Organization",
-                "id": resource_id,
-                "identifier": [{"system": system, "value": value}],
-                "active": True,
-                "name": "Generated Organization",
-            }
-        elif resource_type == "Location":
-            new_resource = {
-                "resourceType": "Location",
-                "id": resource_id,
-                "identifier": [{"system": system, "value": value}],
-                "status": "active",
-                "name": "Generated Location",
-            }
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if response is not None:
+            problem = f"Server returned {response.status_code} for {label}"
         else:
-            # Skip unsupported resource types
-            print(f"Skipping unsupported resource type: {resource_type}")
-            continue
+            problem = f"Upload of {label} failed ({type(error).__name__})"
+        if throttle is not None and response is not None and (
+            response.status_code in BACKPRESSURE_STATUS_CODES
+        ):
+            # The server is shedding load: pause every worker, then retry
+            delay = throttle.back_off(retry_after)
+            print(
+                f"{problem}, pausing uploads for {delay:.1f}s (attempt {attempt}/{max_attempts})"
+            )
+        else:
+            delay = parse_retry_after(retry_after)
+            if delay is None:
+                delay = retry_delay(attempt)
+            print(
+                f"{problem}, retrying in {delay:.1f}s (attempt {attempt}/{max_attempts})"
+            )
+            time.sleep(delay)
+
+    if error is not None:
+        raise error
+
+    # Check for HTTP errors
+    response.raise_for_status()
+
+    return response
+
+
+def upload_split_transaction(
+    bundle_data,
+    base_url,
+    max_entries=None,
+    max_bytes=None,
+    split_workers=4,
+    session=None,
+    throttle=None,
+    max_attempts=5,
+    label="",
+    compression=None,
+):
+    """
+    Upload a bundle as several dependency-ordered transactions (see split_transaction)
+
+    Each level only references resources from earlier levels, so levels are uploaded
+    in order and the transactions within a level in parallel. Upload stops at the
+    first level with a failed transaction.
+
+    Args:
+        bundle_data (dict): The processed FHIR transaction bundle
+        base_url (str): Base URL of the FHIR server
+        max_entries (int): Maximum number of entries per transaction
+        max_bytes (int): Maximum serialized size of the entries in a transaction
+        split_workers (int): Number of transactions uploaded at once
+        session (requests.Session): Session to upload with
+        throttle (UploadThrottle): Shared throttle for 429/503 responses
+        max_attempts (int): Maximum number of attempts per transaction
+        label (str): Name of the bundle used in log messages
+        compression (str): Content-Encoding to compress each transaction with, if any
+
+    Returns:
+        requests.Response: The response to the last transaction
+
+    Raises:
+        requests.exceptions.HTTPError: If a transaction fails
+    """
+    levels = split_transaction(bundle_data, max_entries, max_bytes)
+    print(
+        f"Split into {sum(len(level) for level in levels)} transactions "
+        f"in {len(levels)} dependency levels"
+    )
+
+    def encode(part):
+        payload = json.dumps(part).encode("utf-8")
+        if compression:
+            payload = b"".join(compress_chunks([payload], compression))
+        return {"data": payload}
+
+    response = None
+    with ThreadPoolExecutor(max_workers=max(1, split_workers)) as executor:
+        for level_number, level in enumerate(levels, start=1):
+            futures = [
+                executor.submit(
+                    post_bundle,
+                    base_url,
+                    lambda part=part: encode(part),
+                    session,
+                    throttle,
+                    max_attempts,
+                    f"{label} (level {level_number}, part {i + 1}/{len(level)})",
+                    compression,
+                )
+                for i, part in enumerate(level)
+            ]
+            for future in futures:
+                response = future.result()
+
+    return response
+
+
+def batch_bundle(bundle_data):
+    """
+    Turn a processed transaction bundle into a batch bundle
+
+    A server processes batch entries independently and in order, without resolving
+    references between them, so entries are ordered with the resources they
+    reference first (see split_transaction).
+
+    Args:
+        bundle_data (dict): The processed FHIR transaction bundle
+
+    Returns:
+        dict: A batch bundle with the same entries
+    """
+    return {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [
+            entry
+            for level in split_transaction(bundle_data)
+            for part in level
+            for entry in part["entry"]
+        ],
+    }
+
+
+def batch_failures(batch, response_bundle):
+    """
+    Find the entries of a batch that the server did not accept
+
+    Args:
+        batch (dict): The batch bundle that was sent
+        response_bundle (dict): The server's batch-response bundle, whose entries
+            answer the batch entries in the same order
+
+    Returns:
+        list: (request URL, status, diagnostics or None) of each failed entry
+    """
+    failures = []
+    for entry, result in zip(batch.get("entry", []), response_bundle.get("entry", [])):
+        response = result.get("response", {})
+        status = response.get("status", "")
+        if not status.startswith("2"):
+            issues = (response.get("outcome") or {}).get("issue") or [{}]
+            failures.append((entry["request"]["url"], status, issues[0].get("diagnostics")))
+    return failures
+
+
+class ImportStaging:
+    """
+    NDJSON files of processed bundle resources, staged for a Bulk Data $import
+
+    Resources are appended to one file per resource type as bundles are processed,
+    each resource only once however many bundles contain it. The staged files are
+    recorded so they can be journaled once the import has completed.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.staged = []
+        self.generated_resources = []
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._files = {}
+        self._written = set()
+
+    def add(self, file_path, content_hash, size, resources, generated_resources=()):
+        """
+        Stage the resources of one processed bundle
+
+        Args:
+            file_path (Path): The bundle file
+            content_hash (str): Hash of the bundle file, for the journal
+            size (int): Size of the bundle file in bytes
+            resources (list): The processed resources of the bundle
+            generated_resources (list): Generated resources to record in the registry
+                once the import has completed
+
+        Returns:
+            int: Number of resources written (those not staged by earlier bundles)
+        """
+        lines = [
+            (resource["resourceType"], resource["id"], json.dumps(resource) + "\n")
+            for resource in resources
+        ]
+        written = 0
+        with self._lock:
+            for resource_type, resource_id, line in lines:
+                if (resource_type, resource_id) in self._written:
+                    continue
+                self._written.add((resource_type, resource_id))
+                if resource_type not in self._files:
+                    self._files[resource_type] = open(
+                        self.directory / f"{resource_type}.ndjson", "w"
+                    )
+                self._files[resource_type].write(line)
+                written += 1
+            self.staged.append((file_path, content_hash))
+            self.generated_resources.extend(generated_resources)
+            self.bytes += size
+        return written
+
+    @property
+    def resources(self):
+        return len(self._written)
+
+    @property
+    def resource_types(self):
+        return list(self._files)
+
+    def parameters(self, file_url):
+        """
+        Build the $import request for the staged files
+
+        Args:
+            file_url (str): URL the server fetches the staged files from
+
+        Returns:
+            dict: Parameters resource listing one input per resource type
+        """
+        file_url = file_url.rstrip("/")
+        return {
+            "resourceType": "Parameters",
+            "parameter": [
+                {"name": "inputFormat", "valueCode": "application/fhir+ndjson"},
+                {"name": "inputSource", "valueUri": file_url},
+                {"name": "storageDetail", "part": [{"name": "type", "valueCode": "https"}]},
+            ]
+            + [
+                {
+                    "name": "input",
+                    "part": [
+                        {"name": "type", "valueCode": resource_type},
+                        {"name": "url", "valueUri": f"{file_url}/{resource_type}.ndjson"},
+                    ],
+                }
+                for resource_type in self.resource_types
+            ],
+        }
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+
+
+def serve_directory(directory, file_names, host="127.0.0.1", port=0):
+    """
+    Serve some of the files in a directory over HTTP from a background thread
+
+    Only the named files are served; every other path, including the directory
+    listing, is answered with 404.
+
+    Args:
+        directory (Path): Directory the files are in
+        file_names (list): Names of the files to serve
+        host (str): Address to listen on; the default only accepts local connections
+        port (int): Port to listen on; 0 picks a free port
+
+    Returns:
+        ThreadingHTTPServer: The server; call shutdown() to stop it
+    """
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import unquote, urlsplit
+
+    served_paths = {f"/{name}" for name in file_names}
+
+    class FileHandler(SimpleHTTPRequestHandler):
+        def send_head(self):
+            if unquote(urlsplit(self.path).path) not in served_paths:
+                self.send_error(404)
+                return None
+            return super().send_head()
 
-        # Add the new resource to our new entries list with PUT request
-        new_entries.append(
-            {
-                "resource": new_resource,
-                "request": {"method": "PUT", "url": f"{resource_type}/{resource_id}"},
-            }
+    handler = partial(FileHandler, directory=str(directory))
+    server = ThreadingHTTPServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bulk_import(
+    staging,
+    base_url,
+    file_url=None,
+    session=None,
+    throttle=None,
+    max_attempts=5,
+    bind_address=None,
+):
+    """
+    Load the staged NDJSON files with the server's Bulk Data $import operation
+
+    The staged files are served from this machine while the server fetches them;
+    they hold patient data, so they are only served on the address the server is
+    expected to connect to, and nothing else in the staging directory is. The import
+    is kicked off asynchronously and its status polled until the server reports it
+    complete, waiting for Retry-After between polls when the server gives one.
+
+    Args:
+        staging (ImportStaging): The staged files
+        base_url (str): Base URL of the FHIR server
+        file_url (str): URL the server reaches this machine's file server at, e.g.
+            http://host.docker.internal:8765 for a server in Docker; the files are
+            served on its port. Defaults to http://localhost on a free port.
+        bind_address (str): Address to serve the files on, e.g. the Docker bridge
+            address 172.17.0.1; defaults to the host of file_url, or 127.0.0.1
+        session (requests.Session): Session to send the requests with
+        throttle (UploadThrottle): Shared throttle for 429/503 responses
+        max_attempts (int): Maximum number of attempts of the kick-off request, and of
+            consecutive failed status polls
+
+    Returns:
+        requests.Response: The final status response
+
+    Raises:
+        requests.exceptions.HTTPError: If the import fails
+    """
+    import requests
+    from urllib.parse import urlsplit
+
+    staging.close()
+    http = session if session is not None else requests
+    if file_url:
+        url_parts = urlsplit(file_url)
+        host, port = url_parts.hostname, url_parts.port or 80
+    else:
+        host, port = "127.0.0.1", 0
+    file_names = [f"{resource_type}.ndjson" for resource_type in staging.resource_types]
+    server = serve_directory(staging.directory, file_names, bind_address or host, port)
+    try:
+        file_url = file_url or f"http://localhost:{server.server_port}"
+        parameters = staging.parameters(file_url)
+        print(
+            f"Importing {staging.resources} resources in "
+            f"{len(staging.resource_types)} NDJSON files from {file_url}"
         )
+        response = post_bundle(
+            f"{base_url.rstrip('/')}/$import",
+            lambda: {"json": parameters},
+            session,
+            throttle,
+            max_attempts,
+            "$import",
+            prefer="respond-async",
+        )
+        status_url = response.headers.get("Content-Location")
+        if response.status_code != 202 or not status_url:
+            # The server imported the files synchronously
+            return response
+
+        delay = 1.0
+        failed_polls = 0
+        while True:
+            time.sleep(delay)
+            response = http.get(
+                status_url, headers={"Accept": "application/fhir+json"}, timeout=60
+            )
+            # A 500 reports a failed import; other 429/5xx responses are transient
+            if response.status_code in RETRY_STATUS_CODES and response.status_code != 500:
+                failed_polls += 1
+                if failed_polls >= max_attempts:
+                    break
+                retry_after = parse_retry_after(response.headers.get("Retry-After"))
+                delay = retry_after if retry_after is not None else retry_delay(failed_polls)
+                continue
+            if response.status_code != 202:
+                break
+
+            failed_polls = 0
+            if progress := response.headers.get("X-Progress"):
+                print(f"Import in progress: {progress}")
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            delay = retry_after if retry_after is not None else min(delay * 2, 30.0)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if not response.ok:
+        try:
+            for issue in response.json().get("issue", [])[:3]:  # Show first 3 issues only
+                print(
+                    f"- {issue.get('severity', 'error')}: {issue.get('diagnostics', 'Unknown error')}"
+                )
+        except (ValueError, AttributeError):
+            print(f"Failed to parse error response: {response.content[:200]}")
+    response.raise_for_status()
+    return response
 
-        # Map this search reference to the direct reference
-        direct_ref = f"{resource_type}/{resource_id}"
-        search_refs[ref] = direct_ref
-        created += 1
 
-    # Update all search parameter references in the bundle
-    def update_search_refs(obj):
-        """Update all search parameter references in a nested object"""
-        if isinstance(obj, dict):
-            for key, value in list(obj.items()):
-                if key == "reference" and isinstance(value, str):
-                    # Check if this is a search parameter reference we're resolving
-                    if value in search_refs and search_refs[value] is not None:
-                        obj[key] = search_refs[value]
-                    # Or check if it's a reference to an existing resource
-                    elif value in existing_resources:
-                        obj[key] = existing_resources[value]
-                elif isinstance(value, (dict, list)):
-                    update_search_refs(value)
-        elif isinstance(obj, list):
-            for item in obj:
-                update_search_refs(item)
+class UploadJournal:
+    """
+    Persistent record of the outcome of each bundle upload
 
-    # Update all references in the bundle
-    update_search_refs(bundle_data)
+    Stores each file's content hash, the result of processing it and the server's
+    response in a SQLite database, keyed by the server's base URL. run_fhir_upload
+    skips files that were already uploaded to the server with the same content, and
+    files skipped for lacking the same required LOINC code, so an interrupted run can
+    simply be restarted.
+    """
 
-    # Add the new entries to the beginning of the bundle
-    # This ensures they're created before they're referenced
-    if new_entries:
-        bundle_data["entry"] = new_entries + bundle_data.get("entry", [])
+    def __init__(self, path, base_url):
+        self.path = path
+        self.base_url = base_url.rstrip("/")
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            "server TEXT NOT NULL, file TEXT NOT NULL, content_hash TEXT NOT NULL, "
+            "status TEXT NOT NULL, status_code INTEGER, response TEXT, loinc_code TEXT, "
+            "updated_at TEXT NOT NULL, PRIMARY KEY (server, file))"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def content_hash(file_path, chunk_size=1 << 20):
+        """SHA-256 of a file's bytes"""
+        digest = hashlib.sha256()
+        with open(file_path, "rb") as file:
+            while chunk := file.read(chunk_size):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _status(self, file_path):
+        with self._lock:
+            return self._connection.execute(
+                "SELECT content_hash, status, loinc_code FROM uploads WHERE server = ? AND file = ?",
+                (self.base_url, str(Path(file_path).resolve())),
+            ).fetchone()
+
+    def is_uploaded(self, file_path, content_hash):
+        """Whether this file was already uploaded with the same content"""
+        row = self._status(file_path)
+        return row is not None and row[:2] == (content_hash, "uploaded")
+
+    def is_skipped(self, file_path, content_hash, loinc_code):
+        """Whether this file, with the same content, was skipped for lacking loinc_code"""
+        return self._status(file_path) == (content_hash, "skipped", loinc_code)
+
+    def record(
+        self, file_path, content_hash, status, status_code=None, response=None, loinc_code=None
+    ):
+        """
+        Record the outcome of processing a file
+
+        Args:
+            file_path (Path): The bundle file
+            content_hash (str): Hash of the file content that was processed
+            status (str): "uploaded", "failed" or "skipped"
+            status_code (int): HTTP status code of the server's response, if any
+            response (str): Server response body or error message
+            loinc_code (str): The required LOINC code a skipped file lacks
+        """
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    self.base_url,
+                    str(Path(file_path).resolve()),
+                    content_hash,
+                    status,
+                    status_code,
+                    response,
+                    loinc_code,
+                    datetime.now(timezone.utc).isoformat(),
+                ),
+            )
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def scan_bundle_codes(file_path, known_hash=None, texts=()):
+    """
+    Collect the codes and resource types in a bundle file, for BundleCodeIndex
+
+    Args:
+        file_path (str): Path of the bundle file (.json or .json.gz)
+        known_hash (str): Content hash the file had when it was last scanned; if it
+            still has it, the file is only parsed again to look for texts
+        texts (list): Strings to look for in the bundle's string values, the way
+            process_and_upload_file looks for its required LOINC code
 
-    return bundle_data, created
+    Returns:
+        tuple: (content hash, set of (system, code) pairs or None if the content is
+            unchanged, set of resource types or None if unchanged, set of the texts
+            found, error message or None). Codes are those of every element with a
+            string code, such as Coding and Quantity; the system is "" for codes
+            without one. Files that can't be read or parsed as a bundle get an error
+            message (and no codes) instead of raising.
+    """
+    try:
+        with open(file_path, "rb") as file:
+            raw = file.read()
+    except OSError as e:
+        return "", set(), set(), set(), f"Could not read file: {e}"
+    content_hash = hashlib.sha256(raw).hexdigest()
+    unchanged = content_hash == known_hash
+    if unchanged and not texts:
+        return content_hash, None, None, set(), None
+
+    try:
+        if str(file_path).endswith(".gz"):
+            raw = gzip.decompress(raw)
+        bundle_data = json.loads(raw)
+        if not isinstance(bundle_data, dict):
+            raise ValueError("not a JSON object")
+    except (OSError, EOFError, zlib.error, ValueError) as e:
+        return content_hash, set(), set(), set(), f"Invalid bundle: {e}"
+
+    codes = set()
+    resource_types = set()
+    found = set()
+    remaining = set(texts)
+    # (value, whether it is part of an entry's resource); texts are looked for in the
+    # whole bundle, codes only in the resources
+    stack = []
+    for key, value in bundle_data.items():
+        if key == "entry" and isinstance(value, list):
+            for entry in value:
+                if isinstance(entry, dict):
+                    resource = entry.get("resource")
+                    if isinstance(resource, dict):
+                        resource_types.add(resource.get("resourceType"))
+                    stack.extend((child, name == "resource") for name, child in entry.items())
+                else:
+                    stack.append((entry, False))
+        else:
+            stack.append((value, False))
+
+    while stack:
+        value, in_resource = stack.pop()
+        if isinstance(value, dict):
+            code = value.get("code")
+            if in_resource and isinstance(code, str):
+                system = value.get("system")
+                codes.add((system if isinstance(system, str) else "", code))
+            stack.extend((child, in_resource) for child in value.values())
+        elif isinstance(value, list):
+            stack.extend((child, in_resource) for child in value)
+        elif remaining and isinstance(value, str):
+            for text in [text for text in remaining if text in value]:
+                found.add(text)
+                remaining.discard(text)
+
+    resource_types.discard(None)
+    if unchanged:
+        return content_hash, None, None, found, None
+    return content_hash, codes, resource_types, found, None
+
+
+class BundleCodeIndex:
+    """
+    Persistent index of the codes and resource types in each bundle file
+
+    Lets run_fhir_upload pick the files that contain some codes or resource types
+    without parsing every file on every run. The index is a SQLite database that is
+    updated incrementally: files whose modification time and size are unchanged are
+    not read again, and files that were touched but have the same content hash are
+    not parsed again. Scanning changed files is spread over a process pool.
+
+    Whether a file contains a text in any of its string values, as the required LOINC
+    code check does, is recorded per text the first time it is asked for. Files that
+    can't be parsed are recorded as unindexable, and always selected so that the
+    upload reports them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path)
+        self._connection.executescript(
+            "CREATE TABLE IF NOT EXISTS indexed_files ("
+            "id INTEGER PRIMARY KEY, file TEXT UNIQUE NOT NULL, mtime_ns INTEGER NOT NULL, "
+            "size INTEGER NOT NULL, content_hash TEXT NOT NULL, indexed_at TEXT NOT NULL, "
+            "error TEXT);"
+            "CREATE TABLE IF NOT EXISTS file_codes "
+            "(file_id INTEGER NOT NULL, system TEXT NOT NULL, code TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS file_codes_code ON file_codes (code, system);"
+            "CREATE TABLE IF NOT EXISTS file_resource_types "
+            "(file_id INTEGER NOT NULL, resource_type TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS file_resource_types_type "
+            "ON file_resource_types (resource_type);"
+            "CREATE TABLE IF NOT EXISTS file_texts "
+            "(file_id INTEGER NOT NULL, text TEXT NOT NULL, found INTEGER NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS file_texts_text ON file_texts (text, file_id);"
+        )
+        self._connection.commit()
+
+    def update(self, file_paths, workers=None, texts=()):
+        """
+        Index new and changed files, and drop files that no longer exist
+
+        Args:
+            file_paths (list): Paths of the bundle files to index
+            workers (int): Number of processes scanning files (defaults to the CPU count)
+            texts (list): Texts to record whether each file contains, for
+                select(containing=...)
+
+        Returns:
+            int: Number of files that were parsed
+        """
+        texts = list(texts)
+        known = {
+            file: (file_id, mtime_ns, size, content_hash)
+            for file_id, file, mtime_ns, size, content_hash in self._connection.execute(
+                "SELECT id, file, mtime_ns, size, content_hash FROM indexed_files"
+            )
+        }
+        checked = {}
+        for file_id, text in self._connection.execute("SELECT file_id, text FROM file_texts"):
+            checked.setdefault(file_id, set()).add(text)
+
+        # Only files whose modification time or size changed are read, and unchanged
+        # files that were not yet checked for some of the texts
+        stale = []
+        for file_path in file_paths:
+            file = str(Path(file_path).resolve())
+            stat = os.stat(file)
+            previous = known.get(file)
+            if previous is None or previous[1:3] != (stat.st_mtime_ns, stat.st_size):
+                stale.append((file, stat, previous[3] if previous else None, texts))
+            elif missing := [text for text in texts if text not in checked.get(previous[0], ())]:
+                stale.append((file, stat, previous[3], missing))
+
+        workers = workers or os.cpu_count() or 1
+        if workers > 1 and len(stale) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                scans = executor.map(
+                    scan_bundle_codes,
+                    [file for file, _, _, _ in stale],
+                    [known_hash for _, _, known_hash, _ in stale],
+                    [file_texts for _, _, _, file_texts in stale],
+                    chunksize=max(1, len(stale) // (workers * 4)),
+                )
+                results = list(scans)
+        else:
+            results = [
+                scan_bundle_codes(file, known_hash, file_texts)
+                for file, _, known_hash, file_texts in stale
+            ]
+
+        parsed = 0
+        indexed_at = datetime.now(timezone.utc).isoformat()
+        with self._connection:
+            for (file, stat, _, file_texts), (content_hash, codes, resource_types, found, error) in zip(
+                stale, results
+            ):
+                if codes is None:
+                    # Touched but unchanged: only the modification time is updated
+                    file_id = known[file][0]
+                    self._connection.execute(
+                        "UPDATE indexed_files SET mtime_ns = ?, size = ? WHERE id = ?",
+                        (stat.st_mtime_ns, stat.st_size, file_id),
+                    )
+                else:
+                    parsed += 1
+                    self._remove(file)
+                    file_id = self._connection.execute(
+                        "INSERT INTO indexed_files "
+                        "(file, mtime_ns, size, content_hash, indexed_at, error) "
+                        "VALUES (?, ?, ?, ?, ?, ?)",
+                        (file, stat.st_mtime_ns, stat.st_size, content_hash, indexed_at, error),
+                    ).lastrowid
+                    self._connection.executemany(
+                        "INSERT INTO file_codes VALUES (?, ?, ?)",
+                        [(file_id, system, code) for system, code in codes],
+                    )
+                    self._connection.executemany(
+                        "INSERT INTO file_resource_types VALUES (?, ?)",
+                        [(file_id, resource_type) for resource_type in resource_types],
+                    )
+                self._connection.executemany(
+                    "INSERT INTO file_texts VALUES (?, ?, ?)",
+                    [(file_id, text, text in found) for text in file_texts],
+                )
+
+            for file in known:
+                if not os.path.exists(file):
+                    self._remove(file)
+
+        return parsed
+
+    def unindexable(self):
+        """
+        Files that could not be parsed when they were indexed
+
+        Returns:
+            dict: Error message by resolved path
+        """
+        return dict(
+            self._connection.execute(
+                "SELECT file, error FROM indexed_files WHERE error IS NOT NULL"
+            )
+        )
+
+    def _remove(self, file):
+        row = self._connection.execute(
+            "SELECT id FROM indexed_files WHERE file = ?", (file,)
+        ).fetchone()
+        if row is not None:
+            self._connection.execute("DELETE FROM file_codes WHERE file_id = ?", row)
+            self._connection.execute("DELETE FROM file_resource_types WHERE file_id = ?", row)
+            self._connection.execute("DELETE FROM indexed_files WHERE id = ?", row)
+
+    def select(self, codes=None, resource_types=None, containing=None):
+        """
+        Find the indexed files that contain any of the codes and any of the resource
+        types, and the unindexable files
+
+        Args:
+            codes (list): Codes as "system|code", or "code" to match it in any system;
+                None to not filter by code
+            resource_types (list): Resource types; None to not filter by resource type
+            containing (str): Only files with this text in a string value, which must
+                have been passed to update(); None to not filter by text
+
+        Returns:
+            set: Resolved paths of the matching files
+        """
+        query = "SELECT file FROM indexed_files WHERE error IS NULL"
+        parameters = []
+        if codes is not None:
+            conditions = []
+            for code in codes:
+                system, separator, value = code.rpartition("|")
+                if separator:
+                    conditions.append("(code = ? AND system = ?)")
+                    parameters.extend([value, system])
+                else:
+                    conditions.append("code = ?")
+                    parameters.append(value)
+            query += (
+                " AND id IN (SELECT file_id FROM file_codes WHERE "
+                f"{' OR '.join(conditions) or '0'})"
+            )
+        if resource_types is not None:
+            resource_types = list(resource_types)
+            placeholders = ", ".join("?" * len(resource_types))
+            query += (
+                " AND id IN (SELECT file_id FROM file_resource_types WHERE resource_type IN "
+                f"({placeholders}))"
+            )
+            parameters.extend(resource_types)
+        if containing is not None:
+            query += " AND id IN (SELECT file_id FROM file_texts WHERE text = ? AND found)"
+            parameters.append(containing)
+        query += " OR error IS NOT NULL"
+        return {file for (file,) in self._connection.execute(query, parameters)}
+
+    def close(self):
+        self._connection.close()
+
+
+@contextmanager
+def time_stage(timings, stage):
+    """Add the time spent in the with block to timings[stage], in seconds"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+
+def percentile(values, q):
+    """Linearly interpolated q-th percentile of a non-empty list of numbers"""
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class UploadMetrics:
+    """
+    Per-file stage timings of an upload run
+
+    Each processed file produces one record with its size, number of resources,
+    outcome and the seconds spent in each stage (parse, rewrite, serialize, compress,
+    upload; streamed bundles have index and upload; bundles staged for $import have
+    stage, and the import itself is one more record). Records are optionally appended
+    to a JSON lines file as they arrive, and summary() reports p50/p95/p99 per stage and
+    overall throughput.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._records = []
+        self._file = open(path, "a") if path else None
+        self._start = time.perf_counter()
+
+    def record(self, file_name, status, size, resources, timings):
+        """
+        Record the outcome of one file
+
+        Args:
+            file_name (str): Name of the bundle file
+            status (str): "uploaded", "partial" (some batch entries failed), "staged"
+                (for $import), "failed" or "skipped"
+            size (int): Size of the bundle file in bytes
+            resources (int): Number of entries in the processed bundle that were uploaded
+            timings (dict): Seconds spent in each stage
+        """
+        record = {
+            "time": datetime.now(timezone.utc).isoformat(),
+            "file": file_name,
+            "status": status,
+            "bytes": size,
+            "resources": resources,
+            "stages": {stage: round(seconds, 6) for stage, seconds in timings.items()},
+        }
+        with self._lock:
+            self._records.append(record)
+            if self._file is not None:
+                self._file.write(json.dumps(record) + "\n")
+                self._file.flush()
+
+    def summary(self):
+        """
+        Summarize the recorded files
+
+        Returns:
+            str: Per-stage p50/p95/p99 in milliseconds and bytes and resources per second
+        """
+        elapsed = time.perf_counter() - self._start
+        with self._lock:
+            records = list(self._records)
+
+        stages = {}
+        for record in records:
+            for stage, seconds in record["stages"].items():
+                stages.setdefault(stage, []).append(seconds * 1000)
+
+        lines = [f"{'stage':<10} {'files':>6} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}"]
+        for stage, values in stages.items():
+            lines.append(
+                f"{stage:<10} {len(values):>6} {percentile(values, 50):>10.1f} "
+                f"{percentile(values, 95):>10.1f} {percentile(values, 99):>10.1f}"
+            )
+
+        uploaded = [record for record in records if record["status"] in ("uploaded", "partial")]
+        total_bytes = sum(record["bytes"] for record in uploaded)
+        total_resources = sum(record["resources"] for record in uploaded)
+        lines.append(
+            f"Uploaded {total_bytes / 1e6:.1f} MB and {total_resources} resources in "
+            f"{elapsed:.1f}s ({total_bytes / 1e6 / elapsed:.2f} MB/s, "
+            f"{total_resources / elapsed:.0f} resources/s)"
+        )
+        return "\n".join(lines)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
 
 
 def process_and_upload_file(
@@ -279,9 +2095,28 @@ def process_and_upload_file(
     fix_references=True,
     loinc_code="55232-3",
     saveDebugOutput=False,
+    session=None,
+    throttle=None,
+    max_attempts=5,
+    streaming=False,
+    max_entries=None,
+    max_bytes=None,
+    split_workers=4,
+    registry=None,
+    journal=None,
+    content_hash=None,
+    metrics=None,
+    compression=None,
+    strategy="transaction",
+    staging=None,
 ):
     """
-    Process and upload a FHIR bundle as a single transaction using PUT for update/create
+    Process and upload a FHIR bundle using PUT for update/create
+
+    With the "transaction" strategy the bundle is sent as one transaction (or split
+    into several), with "batch" as one batch whose entries succeed or fail
+    independently; with "import" its resources are only staged for a later $import
+    (see bulk_import).
 
     Args:
         file_path (Path): Path to the FHIR JSON file
@@ -289,78 +2124,219 @@ def process_and_upload_file(
         fix_references (bool): Whether to fix references in the bundle
         loinc_code (str): Required LOINC code (skip files without this code)
         saveDebugOutput (bool): Whether to save processed bundle for debugging
+        session (requests.Session): Session to upload with (a new connection is used if None)
+        throttle (UploadThrottle): Shared throttle; when given, 429/503 responses
+            pause all workers and the upload is retried
+        max_attempts (int): Maximum number of attempts per transaction
+        streaming (bool): Whether to parse, rewrite and send the bundle entry by entry
+            with a chunked request body instead of loading it into memory
+        max_entries (int): If set, split the bundle into transactions of at most this
+            many entries (see split_transaction)
+        max_bytes (int): If set, split the bundle into transactions of at most this
+            many bytes of entries
+        split_workers (int): Number of independent split transactions uploaded at once
+        registry (GeneratedResourceRegistry): Skip generated resources that are
+            already on the server, and record the ones this bundle uploads; the caller
+            releases the bundle's remaining reservations with registry.release()
+        journal (UploadJournal): Journal to record the outcome of the upload in
+        content_hash (str): Hash of the file content, computed if not given
+        metrics (UploadMetrics): Metrics to record the stage timings of this file in
+        compression (str): Compress the request body with this Content-Encoding
+            ("gzip", "deflate" or "zstd"); the server must support it
+        strategy (str): "transaction", "batch" or "import" (see UPLOAD_STRATEGIES);
+            streaming and splitting need "transaction"
+        staging (ImportStaging): Where to stage the resources with the "import" strategy
 
     Returns:
-        tuple: (success boolean, error message or None)
+        tuple: (success boolean, error message or None); with the "import" strategy
+            success means the resources were staged
     """
-    print(f"\nProcessing {file_path.name}...")
-
-    try:
-        with open(file_path, "r") as file:
-            bundle_data = json.load(file)
-    except json.JSONDecodeError as e:
-        raise ValueError(f"Invalid JSON in file: {str(e)}")
-
-    # Check if bundle contains required LOINC code
-    if loinc_code and loinc_code not in json.dumps(bundle_data):
-        raise ValueError(f"Bundle does not contain required LOINC code {loinc_code}")
-
-    num_entries = len(bundle_data.get("entry", []))
+    import requests
 
-    # Apply reference fixing if requested
-    if fix_references:
-        # Fix URN references
-        bundle_data = process_synthea_bundle(bundle_data)
+    print(f"\nProcessing {file_path.name}...")
 
-        # Fix search parameter references
-        bundle_data, created_resources = resolve_search_references(bundle_data)
+    if journal is not None and content_hash is None:
+        content_hash = journal.content_hash(file_path)
 
-        num_entries = len(bundle_data.get("entry", []))
+    timings = {}
+    file_size = file_path.stat().st_size
+    resource_count = 0
 
-    # Count resource types in the bundle
-    resource_types = {}
-    for entry in bundle_data.get("entry", []):
-        resource_type = entry["resource"]["resourceType"]
-        resource_types[resource_type] = resource_types.get(resource_type, 0) + 1
+    def record_metrics(status):
+        if metrics is not None:
+            metrics.record(file_path.name, status, file_size, resource_count, timings)
 
-    # Make sure every entry has a request section with PUT method and proper URL
-    for entry in bundle_data.get("entry", []):
-        if "request" not in entry or entry["request"].get("method") != "PUT":
-            resource = entry["resource"]
-            resource_type = resource["resourceType"]
-            resource_id = resource["id"]
+    if streaming:
+        # Index the bundle now; it is rewritten entry by entry as the body is sent
+        with time_stage(timings, "index"):
+            body, stats = stream_process_bundle(
+                file_path, fix_references, loinc_code, registry
+            )
+        resource_count = stats.get("entries", 0)
+    else:
+        try:
+            with time_stage(timings, "parse"), open_bundle(file_path) as file:
+                bundle_data = json.load(file)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid JSON in file: {str(e)}")
+
+        # Fix URN and search parameter references (if requested) and check that the
+        # bundle contains the required LOINC code in a single pass over the bundle
+        with time_stage(timings, "rewrite"):
+            bundle_data, stats = rewrite_bundle_references(
+                bundle_data,
+                fix_urns=fix_references,
+                resolve_search=fix_references,
+                loinc_code=loinc_code,
+                registry=registry,
+            )
+        resource_count = len(bundle_data.get("entry", []))
+
+    if not stats["code_found"]:
+        if journal is not None:
+            journal.record(
+                file_path,
+                content_hash,
+                "skipped",
+                response=f"Missing LOINC code {loinc_code}",
+                loinc_code=loinc_code,
+            )
+        record_metrics("skipped")
+        raise ValueError(f"Bundle does not contain required LOINC code {loinc_code}")
 
-            # Update to use PUT with resource ID in URL
-            entry["request"] = {
-                "method": "PUT",
-                "url": f"{resource_type}/{resource_id}",
-            }
+    if fix_references:
+        print(f"Found {stats['urn_references']} URN references to fix")
+    if stats["skipped_resources"]:
+        print(f"Skipping {stats['skipped_resources']} generated resources already uploaded")
+
+    if not streaming:
+        # Count resource types in the bundle
+        resource_types = {}
+        for entry in bundle_data.get("entry", []):
+            resource_type = entry["resource"]["resourceType"]
+            resource_types[resource_type] = resource_types.get(resource_type, 0) + 1
+
+        # Make sure every entry has a request section with PUT method and proper URL
+        with time_stage(timings, "rewrite"):
+            for entry in bundle_data.get("entry", []):
+                ensure_put_request(entry)
 
     # Save the processed bundle for debugging
     if saveDebugOutput:
-        debug_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        debug_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
         debug_file = Path(f"processed_bundle_{debug_timestamp}.json")
-        with open(debug_file, "w") as f:
-            json.dump(bundle_data, f, indent=2)
+        if streaming:
+            with open(debug_file, "wb") as f:
+                f.writelines(body())
+        else:
+            with open(debug_file, "w") as f:
+                json.dump(bundle_data, f, indent=2)
         print(f"Saved processed bundle for debugging to: {debug_file}")
 
+    if strategy == "import":
+        with time_stage(timings, "stage"):
+            written = staging.add(
+                file_path,
+                content_hash,
+                file_size,
+                [entry["resource"] for entry in bundle_data.get("entry", [])],
+                stats["generated_resources"],
+            )
+        if registry is not None:
+            registry.mark_staged(stats["generated_resources"])
+        record_metrics("staged")
+        print(f"Staged {written} new resources for bulk import")
+        return True, None
+
     # Upload the bundle
     try:
-        headers = {
-            "Content-Type": "application/fhir+json",
-            "Accept": "application/fhir+json",
-            "Prefer": "return=minimal",  # Minimize response size
-        }
-
-        response = requests.post(
-            base_url,
-            json=bundle_data,
-            headers=headers,
-            timeout=300,  # 5 minutes timeout for large bundles
-        )
-
-        # Check for HTTP errors
-        response.raise_for_status()
+        if streaming:
+            # A generator body is sent with chunked transfer encoding, so the bundle
+            # is serialized during the upload
+            with time_stage(timings, "upload"):
+                response = post_bundle(
+                    base_url,
+                    lambda: {
+                        "data": compress_chunks(body(), compression) if compression else body()
+                    },
+                    session,
+                    throttle,
+                    max_attempts,
+                    file_path.name,
+                    compression,
+                )
+        elif max_entries or max_bytes:
+            # Each split transaction is serialized as it is uploaded
+            with time_stage(timings, "upload"):
+                response = upload_split_transaction(
+                    bundle_data,
+                    base_url,
+                    max_entries,
+                    max_bytes,
+                    split_workers,
+                    session,
+                    throttle,
+                    max_attempts,
+                    file_path.name,
+                    compression,
+                )
+        else:
+            # Serialize once so retries resend the same bytes
+            with time_stage(timings, "serialize"):
+                if strategy == "batch":
+                    bundle_data = batch_bundle(bundle_data)
+                payload = json.dumps(bundle_data).encode("utf-8")
+            if compression:
+                with time_stage(timings, "compress"):
+                    payload = b"".join(compress_chunks([payload], compression))
+            with time_stage(timings, "upload"):
+                response = post_bundle(
+                    base_url,
+                    lambda: {"data": payload},
+                    session,
+                    throttle,
+                    max_attempts,
+                    file_path.name,
+                    compression,
+                )
+
+        if strategy == "batch":
+            failed = batch_failures(bundle_data, response.json() if response.content else {})
+            if failed:
+                # The other entries were stored; retrying the file resends them all,
+                # which is safe since every entry is an idempotent PUT
+                failed_urls = {url for url, _, _ in failed}
+                if registry is not None:
+                    registry.mark_uploaded(
+                        [
+                            resource
+                            for resource in stats["generated_resources"]
+                            if f"{resource['resourceType']}/{resource['id']}" not in failed_urls
+                        ]
+                    )
+                if journal is not None:
+                    journal.record(
+                        file_path, content_hash, "failed", response.status_code, response.text
+                    )
+                resource_count -= len(failed)
+                record_metrics("partial")
+
+                print(f"{len(failed)} of {len(bundle_data['entry'])} batch entries failed")
+                for url, status, diagnostics in failed[:3]:  # Show first 3 failures only
+                    print(f"- {url}: {status} {diagnostics or ''}")
+                url, status, _ = failed[0]
+                return False, (
+                    f"{len(failed)} of {len(bundle_data['entry'])} batch entries failed "
+                    f"(first: {url} {status})"
+                )
+
+        if registry is not None:
+            registry.mark_uploaded(stats["generated_resources"])
+        if journal is not None:
+            journal.record(
+                file_path, content_hash, "uploaded", response.status_code, response.text
+            )
+        record_metrics("uploaded")
 
         print(f"Upload response status: {response.status_code}")
         return True, None
@@ -372,7 +2348,7 @@ def process_and_upload_file(
         # Log detailed error information
         try:
             error_content = e.response.json()
-            error_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            error_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
             error_file = Path(f"error_{error_timestamp}.json")
             with open(error_file, "w") as f:
                 json.dump(error_content, f, indent=2)
@@ -387,18 +2363,69 @@ def process_and_upload_file(
         except (json.JSONDecodeError, KeyError, AttributeError):
             print(f"Failed to parse error response: {e.response.content[:200]}")
 
+        if journal is not None:
+            journal.record(
+                file_path, content_hash, "failed", e.response.status_code, e.response.text
+            )
+        record_metrics("failed")
         return False, str(e)
 
     except Exception as e:
         print(f"Unexpected error during upload: {str(e)}")
+        if journal is not None:
+            journal.record(file_path, content_hash, "failed", response=str(e))
+        record_metrics("failed")
         return False, str(e)
 
 
 def run_fhir_upload(
-    directory_path, base_url, max_files=5, fix_references=True, loinc_code="55232-3"
+    directory_path,
+    base_url,
+    max_files=5,
+    fix_references=True,
+    loinc_code="55232-3",
+    workers=1,
+    streaming=False,
+    max_entries=None,
+    max_bytes=None,
+    split_workers=4,
+    registry_path=None,
+    journal_path=None,
+    metrics_path=None,
+    compression=None,
+    strategy="transaction",
+    import_dir=None,
+    import_url=None,
+    import_bind_address=None,
+    index_path=None,
+    codes=None,
+    resource_types=None,
 ):
     """
-    Run the FHIR upload process for JSON files in a directory
+    Run the FHIR upload process for JSON files (.json or .json.gz) in a directory
+
+    Files are processed and uploaded by a pool of `workers` threads sharing one
+    pooled HTTP session. At most `workers` files are in flight at a time, and all
+    workers pause when the server responds with 429 or 503.
+
+    With a journal, files already uploaded to the server with the same content are
+    skipped without counting towards max_files, so re-running after a crash or
+    failures only uploads the remaining and failed files. Files that lacked loinc_code
+    are not parsed again either.
+
+    The strategy decides how bundles reach the server. "transaction" is the safest
+    and slowest: the server validates every reference and stores each bundle in one
+    database transaction. "batch" stores each entry on its own, so a bad entry only
+    fails itself. "import" writes the resources of all processed bundles to NDJSON
+    files and loads them with a single Bulk Data $import at the end of the run, if the
+    server supports it. The metrics summary reports the throughput of each.
+
+    With an index, or codes or resource types to select files by, the files are first
+    indexed (see BundleCodeIndex) and only those containing loinc_code (anywhere in a
+    string value, as without the index), any of the codes and any of the resource
+    types are processed, so the others are never parsed. A persistent index only
+    re-reads files that changed since the last run. Files the index can't parse are
+    still processed, so their errors are reported.
 
     Args:
         directory_path (str): Path to directory containing FHIR JSON files
@@ -406,50 +2433,227 @@ def run_fhir_upload(
         max_files (int): Maximum number of files to process
         fix_references (bool): Whether to fix references in bundles
         loinc_code (str): Required LOINC code (skip files without this code)
+        workers (int): Number of files to process and upload concurrently
+        streaming (bool): Whether to stream bundles entry by entry instead of loading
+            each one into memory (see process_and_upload_file)
+        max_entries (int): Split each bundle into transactions of at most this many entries
+        max_bytes (int): Split each bundle into transactions of at most this many bytes
+        split_workers (int): Number of split transactions of each file uploaded at once
+        registry_path (str): SQLite file recording the generated Practitioner,
+            Organization and Location resources already uploaded, so each is only sent
+            once across files and runs (see GeneratedResourceRegistry)
+        journal_path (str): SQLite file recording the outcome of each upload
+            (see UploadJournal)
+        metrics_path (str): JSON lines file to append per-file stage timings to
+            (see UploadMetrics); a summary is printed at the end of the run either way
+        compression (str): Compress request bodies with this Content-Encoding
+            ("gzip", "deflate" or "zstd"); the server must support it
+        strategy (str): "transaction", "batch" or "import" (see UPLOAD_STRATEGIES)
+        import_dir (str): Directory to stage the NDJSON files in with the "import"
+            strategy (a temporary directory if None)
+        import_url (str): URL the server fetches the staged files from (see bulk_import)
+        import_bind_address (str): Address to serve the staged files on, if not the
+            host of import_url (see bulk_import)
+        index_path (str): SQLite file with the codes and resource types of each file
+            (see BundleCodeIndex); a temporary in-memory index is used when only codes
+            or resource_types are given
+        codes (list): Only upload files with any of these codes, as "system|code" or
+            "code" (in any system)
+        resource_types (list): Only upload files with any of these resource types
 
     Returns:
         tuple: (list of successful files, list of failed files with errors)
     """
+    if strategy not in UPLOAD_STRATEGIES:
+        raise ValueError(
+            f"Unknown upload strategy {strategy!r}; expected one of {', '.join(UPLOAD_STRATEGIES)}"
+        )
+    if streaming and (max_entries or max_bytes):
+        raise ValueError("Splitting transactions needs the whole bundle; disable streaming")
+    if strategy != "transaction" and (streaming or max_entries or max_bytes):
+        raise ValueError("Streaming and splitting need the transaction upload strategy")
+    check_compression(compression)
+
     # Path to your FHIR JSON files
     directory = Path(directory_path)
 
     # Process files
-    successful_files = []
-    failed_files = []
     processed_count = 0
 
     print(f"Searching for JSON files in {directory}...")
-    json_files = list(directory.glob("*.json"))
+    json_files = [path for pattern in BUNDLE_PATTERNS for path in directory.glob(pattern)]
     print(f"Found {len(json_files)} JSON files")
 
-    for file_path in json_files:
-        if processed_count >= max_files:
-            print(f"Reached maximum file limit ({max_files})")
-            break
-
+    if index_path or codes or resource_types:
+        code_index = BundleCodeIndex(index_path or ":memory:")
+        try:
+            parsed = code_index.update(json_files, texts=[loinc_code] if loinc_code else ())
+            print(f"Indexed {parsed} new or changed files")
+            selected = code_index.select(codes, resource_types, loinc_code or None)
+            unindexable = code_index.unindexable()
+        finally:
+            code_index.close()
+        json_files = [path for path in json_files if str(path.resolve()) in selected]
+        for path in json_files:
+            if str(path.resolve()) in unindexable:
+                print(f"Could not index {path.name}: {unindexable[str(path.resolve())]}")
+        print(f"Selected {len(json_files)} files by their codes and resource types")
+
+    workers = max(1, workers)
+    # Every worker may have split_workers transactions of its file in flight
+    split_workers = max(1, split_workers)
+    session = create_upload_session(workers * split_workers if max_entries or max_bytes else workers)
+    throttle = UploadThrottle()
+    registry = GeneratedResourceRegistry(registry_path, base_url) if registry_path else None
+    journal = UploadJournal(journal_path, base_url) if journal_path else None
+    metrics = UploadMetrics(metrics_path)
+    staging = None
+    if strategy == "import":
+        import tempfile
+
+        staging = ImportStaging(import_dir or tempfile.mkdtemp(prefix="fhir-import-"))
+
+    def upload(file_path):
+        content_hash = None
+        if journal is not None:
+            content_hash = journal.content_hash(file_path)
+            if journal.is_uploaded(file_path, content_hash):
+                return None
+            if journal.is_skipped(file_path, content_hash, loinc_code):
+                raise ValueError(
+                    f"Bundle does not contain required LOINC code {loinc_code} (journaled)"
+                )
+
+        # Process and upload file - the LOINC check happens inside this function
         try:
-            # Process and upload file - the LOINC check happens inside this function
-            success, error = process_and_upload_file(
-                file_path, base_url, fix_references, loinc_code
+            return process_and_upload_file(
+                file_path,
+                base_url,
+                fix_references,
+                loinc_code,
+                session=session,
+                throttle=throttle,
+                streaming=streaming,
+                max_entries=max_entries,
+                max_bytes=max_bytes,
+                split_workers=split_workers,
+                registry=registry,
+                journal=journal,
+                content_hash=content_hash,
+                metrics=metrics,
+                compression=compression,
+                strategy=strategy,
+                staging=staging,
             )
-
-            processed_count += 1
-
-            if success:
-                successful_files.append(file_path.name)
-                print(f"Successfully processed {file_path.name}")
-            else:
-                error_summary = error if error else "Unknown error"
-                failed_files.append((file_path.name, error_summary))
-                print(f"Failed to process {file_path.name}: {error_summary[:200]}")
-
-        except ValueError as ve:
-            # Skip files that don't contain the required LOINC code
-            print(f"Skipping {file_path.name}: {str(ve)}")
-            continue
-        except Exception as e:
-            print(f"Error processing {file_path.name}: {str(e)}")
-            failed_files.append((file_path.name, str(e)))
+        finally:
+            if registry is not None:
+                # Let bundles waiting for generated resources this one did not upload send them
+                registry.release()
+
+    # Results are keyed by position in json_files so reporting follows file order
+    successes = {}
+    failures = {}
+    remaining_files = iter(enumerate(json_files))
+    in_flight = {}
+
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            # Only keep enough files in flight to reach max_files; skipped files
+            # do not count, so more are submitted as those complete
+            while len(in_flight) < workers and processed_count + len(in_flight) < max_files:
+                next_file = next(remaining_files, None)
+                if next_file is None:
+                    break
+                index, file_path = next_file
+                in_flight[executor.submit(upload, file_path)] = (index, file_path)
+
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                index, file_path = in_flight.pop(future)
+
+                try:
+                    result = future.result()
+                    if result is None:
+                        print(f"Skipping {file_path.name}: already uploaded")
+                        continue
+
+                    success, error = result
+                    processed_count += 1
+
+                    if success:
+                        successes[index] = file_path.name
+                        print(f"Successfully processed {file_path.name}")
+                    else:
+                        error_summary = error if error else "Unknown error"
+                        failures[index] = (file_path.name, error_summary)
+                        print(f"Failed to process {file_path.name}: {error_summary[:200]}")
+
+                except ValueError as ve:
+                    # Skip files that don't contain the required LOINC code
+                    print(f"Skipping {file_path.name}: {str(ve)}")
+                    continue
+                except Exception as e:
+                    print(f"Error processing {file_path.name}: {str(e)}")
+                    failures[index] = (file_path.name, str(e))
+
+        if staging is not None and staging.staged:
+            # Load everything staged with one $import; the staged files only count as
+            # uploaded once it has completed
+            timings = {}
+            try:
+                with time_stage(timings, "import"):
+                    response = bulk_import(
+                        staging,
+                        base_url,
+                        import_url,
+                        session,
+                        throttle,
+                        bind_address=import_bind_address,
+                    )
+                if registry is not None:
+                    registry.mark_uploaded(staging.generated_resources)
+                if journal is not None:
+                    for file_path, content_hash in staging.staged:
+                        journal.record(
+                            file_path,
+                            content_hash,
+                            "uploaded",
+                            response.status_code,
+                            response.text,
+                        )
+                metrics.record("$import", "uploaded", staging.bytes, staging.resources, timings)
+                print(f"Import response status: {response.status_code}")
+            except Exception as e:
+                print(f"Bulk import failed: {str(e)}")
+                if journal is not None:
+                    for file_path, content_hash in staging.staged:
+                        journal.record(file_path, content_hash, "failed", response=str(e))
+                metrics.record("$import", "failed", staging.bytes, 0, timings)
+                for index in list(successes):
+                    failures[index] = (successes.pop(index), f"Bulk import failed: {str(e)}")
+
+    if staging is not None:
+        staging.close()
+        if import_dir is None:
+            import shutil
+
+            shutil.rmtree(staging.directory, ignore_errors=True)
+
+    if registry is not None:
+        registry.close()
+    if journal is not None:
+        journal.close()
+    metrics.close()
+
+    if processed_count >= max_files and next(remaining_files, None) is not None:
+        print(f"Reached maximum file limit ({max_files})")
+
+    successful_files = [successes[index] for index in sorted(successes)]
+    failed_files = [failures[index] for index in sorted(failures)]
 
     # Print summary
     print("\n======= UPLOAD RESULTS =======")
@@ -462,18 +2666,26 @@ def run_fhir_upload(
         for file_name, error in failed_files:
             print(f"- {file_name}: {error[:100]}...")
 
+    print("\n======= UPLOAD METRICS =======")
+    print(f"Upload strategy: {strategy}")
+    print(metrics.summary())
+
     return successful_files, failed_files
 
 
-def test_fhir_connection():
+def test_fhir_connection(api_base=None):
     """
     Test the connection to the FHIR server by requesting Patient resources
 
+    Args:
+        api_base (str): FHIR server URL (defaults to the FHIR_SERVER environment variable)
+
     Returns:
         dict: The response from the FHIR server
     """
     # Simple request to test connection
     try:
+        smart = get_fhir_client(api_base)
         patient_bundle = smart.server.request_json("Patient")
         print("FHIR server connection successful")
         return patient_bundle
@@ -485,13 +2697,50 @@ def test_fhir_connection():
 if __name__ == "__main__":
     # Execute code only when running as a script, not when imported
 
+    # Load the FHIR server URL from environment variables
+    API_BASE = get_api_base()
+    print(f"Using FHIR server at: {API_BASE}")
+
     # Test connection first http://localhost:8080/fhir/Patient
-    test_result = test_fhir_connection()
+    test_result = test_fhir_connection(API_BASE)
 
     if test_result is not None:
         # Run the uploader with default settings
         print("\nStarting FHIR bundle upload process...")
-        run_fhir_upload("./fhir-data", API_BASE, max_files=5, fix_references=True)
+        # Set FHIR_UPLOAD_WORKERS to upload several bundles concurrently
+        workers = int(os.environ.get("FHIR_UPLOAD_WORKERS", "1"))
+        # Set FHIR_UPLOAD_REGISTRY to a file path to upload each generated resource once
+        registry_path = os.environ.get("FHIR_UPLOAD_REGISTRY")
+        # Set FHIR_UPLOAD_JOURNAL to a file path to skip files uploaded by earlier runs
+        journal_path = os.environ.get("FHIR_UPLOAD_JOURNAL")
+        # Set FHIR_UPLOAD_METRICS to a file path to write per-file timings as JSON lines
+        metrics_path = os.environ.get("FHIR_UPLOAD_METRICS")
+        # Set FHIR_UPLOAD_COMPRESSION to gzip, deflate or zstd to compress uploads
+        compression = os.environ.get("FHIR_UPLOAD_COMPRESSION") or None
+        # Set FHIR_UPLOAD_STRATEGY to batch or import to upload without transactions,
+        # and FHIR_UPLOAD_IMPORT_URL to the URL the server can fetch $import files from
+        # (FHIR_UPLOAD_IMPORT_BIND to the address to serve them on, if not its host)
+        strategy = os.environ.get("FHIR_UPLOAD_STRATEGY") or "transaction"
+        import_url = os.environ.get("FHIR_UPLOAD_IMPORT_URL") or None
+        import_bind_address = os.environ.get("FHIR_UPLOAD_IMPORT_BIND") or None
+        # Set FHIR_UPLOAD_INDEX to a file path to pick files by their codes without
+        # parsing every file on every run
+        index_path = os.environ.get("FHIR_UPLOAD_INDEX")
+        run_fhir_upload(
+            "./fhir-data",
+            API_BASE,
+            max_files=5,
+            fix_references=True,
+            workers=workers,
+            registry_path=registry_path,
+            journal_path=journal_path,
+            metrics_path=metrics_path,
+            compression=compression,
+            strategy=strategy,
+            import_url=import_url,
+            import_bind_address=import_bind_address,
+            index_path=index_path,
+        )
     else:
         print("Aborting due to connection failure.")
         exit(1)
@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#     "flask",
+# ]
+# ///
+# coding: utf-8
+
+"""
+Local stub FHIR server for benchmarking
+
+Emulates just enough of a FHIR server to benchmark load_data.py and the bulk data
+helpers offline: transaction and batch bundle uploads (POST to the base URL,
+optionally gzip, deflate or zstd compressed), Bulk Data $import of NDJSON files
+fetched from URLs, and a SMART Backend Services protected Bulk Data $export
+(smart-configuration, the JWT token endpoint, kick-off, status polling with
+Retry-After and X-Progress, and NDJSON downloads served from a local file,
+optionally gzipped). Uploaded bundles and imported files are read but not stored.
+Every request can be delayed by a fixed latency to emulate a remote server, and
+resources of chosen types can be rejected to exercise partial batch failures.
+
+Client assertions sent to the token endpoint are checked for the claims
+BulkDataFetcher sets but their signatures are not verified, so any RSA key works.
+
+Usage:
+    uv run ./script/stub_fhir_server.py [--port 8090] [--latency 0.05] [--auth]
+        [--ndjson workshops/bulk-data/synthea_10.ndjson] [--patients N]
+        [--files-per-type N] [--export-delay 2] [--poll-interval 1] [--compress]
+        [--reject TYPE ...]
+
+With BulkDataFetcher('http://127.0.0.1:8090/fhir', ...) any client_id, private key
+and key ID are accepted.
+"""
+
+import argparse
+import base64
+import json
+import re
+import secrets
+import tempfile
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import make_server
+
+import synthetic_data
+
+# Optional: needed to accept zstd compressed uploads
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RESOURCE_TYPE_PATTERN = re.compile(rb'"resourceType"\s*:\s*"([A-Za-z]+)"')
+
+
+def index_ndjson(ndjson_path):
+    """
+    Index the lines of an NDJSON file by resource type
+
+    Args:
+        ndjson_path (str): Path to the NDJSON file
+
+    Returns:
+        dict: Resource type to list of (offset, length) of its lines
+    """
+    index = {}
+    offset = 0
+    with open(ndjson_path, "rb") as file:
+        for line in file:
+            match = RESOURCE_TYPE_PATTERN.search(line)
+            if match:
+                index.setdefault(match.group(1).decode(), []).append((offset, len(line)))
+            offset += len(line)
+    return index
+
+
+def decode_jwt_claims(token):
+    """Decode the claims of a JWT without verifying its signature"""
+    payload = token.split(".")[1]
+    return json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+
+
+def split_evenly(items, parts):
+    """Split a list into `parts` consecutive, nearly equal, non-empty lists"""
+    parts = max(1, min(parts, len(items)))
+    size, extra = divmod(len(items), parts)
+    chunks = []
+    start = 0
+    for i in range(parts):
+        end = start + size + (i < extra)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def create_app(
+    ndjson_path=None,
+    latency=0.0,
+    export_delay=0.0,
+    poll_interval=1,
+    files_per_type=1,
+    require_auth=False,
+    token_lifetime=300,
+    compress_downloads=False,
+    reject_types=(),
+):
+    """
+    Create the stub server
+
+    Args:
+        ndjson_path (str): NDJSON file whose resources $export returns
+        latency (float): Seconds every request is delayed by
+        export_delay (float): Seconds an export stays in progress before it completes
+        poll_interval (int): Retry-After sent while an export is in progress
+        files_per_type (int): Number of output files each resource type is split into
+        require_auth (bool): Whether $export requests need a token from the token endpoint
+        token_lifetime (int): Seconds issued access tokens are valid for
+        compress_downloads (bool): Whether to gzip NDJSON files for clients that accept it
+        reject_types (list): Resource types whose uploads are rejected with 422: the
+            whole transaction, or only those entries of a batch
+
+    Returns:
+        Flask: The application; its "STUB_STATS" config holds request counters
+    """
+    app = Flask(__name__)
+    index = index_ndjson(ndjson_path) if ndjson_path else {}
+    jobs = {}
+    imports = {}
+    tokens = {}
+    lock = threading.Lock()
+    stats = {
+        "transactions": 0,
+        "batches": 0,
+        "entries": 0,
+        "rejected_entries": 0,
+        "imports": 0,
+        "imported_resources": 0,
+        "bytes_received": 0,
+        "bytes_decoded": 0,
+        "tokens": 0,
+        "exports": 0,
+        "status_polls": 0,
+        "bytes_sent": 0,
+    }
+    app.config["STUB_STATS"] = stats
+
+    def token_endpoint():
+        return f"{request.host_url}fhir/auth/token"
+
+    def unauthorized():
+        """Return an error response if the request needs a valid token and has none"""
+        if not require_auth:
+            return None
+        token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        with lock:
+            expires = tokens.get(token)
+        if expires is None or expires < time.monotonic():
+            return jsonify({"resourceType": "OperationOutcome"}), 401
+        return None
+
+    @app.before_request
+    def delay():
+        if latency:
+            time.sleep(latency)
+
+    @app.get("/fhir/metadata")
+    def metadata():
+        return jsonify(
+            {
+                "resourceType": "CapabilityStatement",
+                "status": "active",
+                "kind": "instance",
+                "fhirVersion": "4.0.1",
+                "format": ["json"],
+            }
+        )
+
+    @app.get("/fhir/.well-known/smart-configuration")
+    def smart_configuration():
+        return jsonify(
+            {
+                "token_endpoint": token_endpoint(),
+                "token_endpoint_auth_methods_supported": ["private_key_jwt"],
+                "token_endpoint_auth_signing_alg_values_supported": ["RS384", "ES384"],
+                "grant_types_supported": ["client_credentials"],
+                "scopes_supported": ["system/*.read"],
+                "capabilities": ["client-confidential-asymmetric"],
+            }
+        )
+
+    @app.post("/fhir/auth/token")
+    def token():
+        form = request.form
+        if form.get("grant_type") != "client_credentials" or form.get(
+            "client_assertion_type"
+        ) != "urn:ietf:params:oauth:client-assertion-type:jwt-bearer":
+            return jsonify({"error": "invalid_request"}), 400
+        try:
+            claims = decode_jwt_claims(form["client_assertion"])
+        except (KeyError, IndexError, ValueError):
+            return jsonify({"error": "invalid_client"}), 400
+        if (
+            claims.get("iss") != claims.get("sub")
+            or claims.get("aud") != token_endpoint()
+            or claims.get("exp", 0) < time.time()
+        ):
+            return jsonify({"error": "invalid_client"}), 400
+
+        access_token = secrets.token_urlsafe(24)
+        with lock:
+            tokens[access_token] = time.monotonic() + token_lifetime
+            stats["tokens"] += 1
+        return jsonify(
+            {
+                "access_token": access_token,
+                "token_type": "bearer",
+                "expires_in": token_lifetime,
+                "scope": form.get("scope", "system/*.read"),
+            }
+        )
+
+    @app.post("/fhir")
+    def transaction():
+        encoding = request.headers.get("Content-Encoding")
+        if encoding in ("gzip", "deflate"):
+            # wbits=47 detects the gzip or zlib header
+            decompressor = zlib.decompressobj(wbits=47)
+        elif encoding == "zstd" and zstandard is not None:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        elif encoding:
+            return jsonify({"resourceType": "OperationOutcome"}), 415
+        else:
+            decompressor = None
+
+        # Read the body in chunks so chunked (streamed) uploads are consumed as sent
+        received = 0
+        chunks = []
+        try:
+            while chunk := request.stream.read(1 << 16):
+                received += len(chunk)
+                chunks.append(decompressor.decompress(chunk) if decompressor else chunk)
+            body = b"".join(chunks)
+            bundle = json.loads(body)
+        except (zlib.error, ValueError):
+            return jsonify({"resourceType": "OperationOutcome"}), 400
+
+        entries = bundle.get("entry", [])
+        rejected = [
+            entry.get("resource", {}).get("resourceType") in reject_types for entry in entries
+        ]
+        batch = bundle.get("type") == "batch"
+        with lock:
+            stats["batches" if batch else "transactions"] += 1
+            stats["entries"] += len(entries)
+            stats["rejected_entries"] += sum(rejected)
+            stats["bytes_received"] += received
+            stats["bytes_decoded"] += len(body)
+
+        if not batch:
+            if any(rejected):
+                return jsonify({"resourceType": "OperationOutcome"}), 422
+            return jsonify({"resourceType": "Bundle", "type": "transaction-response"})
+
+        # Batch entries succeed or fail on their own
+        outcome = {
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "processing", "diagnostics": "Rejected"}],
+        }
+        return jsonify(
+            {
+                "resourceType": "Bundle",
+                "type": "batch-response",
+                "entry": [
+                    {"response": {"status": "422 Unprocessable Entity", "outcome": outcome}}
+                    if reject
+                    else {"response": {"status": "201 Created"}}
+                    for reject in rejected
+                ],
+            }
+        )
+
+    @app.post("/fhir/$import")
+    def import_kick_off():
+        parameters = request.get_json(force=True, silent=True) or {}
+        urls = [
+            part["valueUri"]
+            for parameter in parameters.get("parameter", [])
+            if parameter.get("name") == "input"
+            for part in parameter.get("part", [])
+            if part.get("name") == "url"
+        ]
+        job_id = uuid.uuid4().hex
+        job = {"done": False, "error": None, "resources": 0}
+
+        def run():
+            # Fetch every input file, as a server does, and count its resources
+            try:
+                for url in urls:
+                    with urllib.request.urlopen(url) as response:
+                        for line in response:
+                            if line.strip():
+                                job["resources"] += 1
+                with lock:
+                    stats["imported_resources"] += job["resources"]
+            except OSError as e:
+                job["error"] = str(e)
+            job["done"] = True
+
+        with lock:
+            imports[job_id] = job
+            stats["imports"] += 1
+        threading.Thread(target=run, daemon=True).start()
+        return Response(
+            status=202,
+            headers={
+                "Content-Location": f"{request.host_url}fhir/$import-poll-status?_jobId={job_id}"
+            },
+        )
+
+    @app.get("/fhir/$import-poll-status")
+    def import_status():
+        job = imports.get(request.args.get("_jobId"))
+        if job is None:
+            return jsonify({"resourceType": "OperationOutcome"}), 404
+        if not job["done"]:
+            return Response(status=202, headers={"Retry-After": str(poll_interval)})
+        if job["error"]:
+            issue = {"severity": "error", "code": "exception", "diagnostics": job["error"]}
+            return jsonify({"resourceType": "OperationOutcome", "issue": [issue]}), 500
+        issue = {
+            "severity": "information",
+            "code": "informational",
+            "diagnostics": f"Imported {job['resources']} resources",
+        }
+        return jsonify({"resourceType": "OperationOutcome", "issue": [issue]})
+
+    @app.get("/fhir/<resource_type>")
+    def search(resource_type):
+        return jsonify(
+            {"resourceType": "Bundle", "type": "searchset", "total": 0, "entry": []}
+        )
+
+    @app.get("/fhir/$export")
+    @app.get("/fhir/Patient/$export")
+    @app.get("/fhir/Group/<group_id>/$export")
+    def kick_off(group_id=None):
+        if error := unauthorized():
+            return error
+        requested = request.args.get("_type")
+        types = requested.split(",") if requested else list(index)
+        job_id = uuid.uuid4().hex
+        with lock:
+            jobs[job_id] = {
+                "started": time.monotonic(),
+                "transaction_time": datetime.now(timezone.utc).isoformat(),
+                "request": request.url,
+                "files": {
+                    resource_type: split_evenly(index[resource_type], files_per_type)
+                    for resource_type in types
+                    if resource_type in index
+                },
+            }
+            stats["exports"] += 1
+        return Response(
+            status=202,
+            headers={"Content-Location": f"{request.host_url}fhir/export-status/{job_id}"},
+        )
+
+    @app.get("/fhir/export-status/<job_id>")
+    def export_status(job_id):
+        if error := unauthorized():
+            return error
+        job = jobs.get(job_id)
+        if job is None:
+            return jsonify({"resourceType": "OperationOutcome"}), 404
+
+        with lock:
+            stats["status_polls"] += 1
+        elapsed = time.monotonic() - job["started"]
+        if elapsed < export_delay:
+            return Response(
+                status=202,
+                headers={
+                    "Retry-After": str(poll_interval),
+                    "X-Progress": f"{int(100 * elapsed / export_delay)}% complete",
+                },
+            )
+
+        return jsonify(
+            {
+                "transactionTime": job["transaction_time"],
+                "request": job["request"],
+                "requiresAccessToken": require_auth,
+                "output": [
+                    {
+                        "type": resource_type,
+                        "url": f"{request.host_url}fhir/export-files/{job_id}/{resource_type}/{part}.ndjson",
+                        "count": len(lines),
+                    }
+                    for resource_type, parts in job["files"].items()
+                    for part, lines in enumerate(parts)
+                ],
+                "error": [],
+            }
+        )
+
+    @app.delete("/fhir/export-status/<job_id>")
+    def delete_export(job_id):
+        with lock:
+            jobs.pop(job_id, None)
+        return Response(status=202)
+
+    @app.get("/fhir/export-files/<job_id>/<resource_type>/<int:part>.ndjson")
+    def export_file(job_id, resource_type, part):
+        if error := unauthorized():
+            return error
+        parts = jobs.get(job_id, {}).get("files", {}).get(resource_type, [])
+        if part >= len(parts):
+            return jsonify({"resourceType": "OperationOutcome"}), 404
+
+        def lines():
+            with open(ndjson_path, "rb") as file:
+                for offset, length in parts[part]:
+                    file.seek(offset)
+                    yield file.read(length)
+
+        def gzipped(chunks):
+            compressor = zlib.compressobj(wbits=31)
+            for chunk in chunks:
+                if compressed := compressor.compress(chunk):
+                    yield compressed
+            yield compressor.flush()
+
+        def counted(chunks):
+            for chunk in chunks:
+                with lock:
+                    stats["bytes_sent"] += len(chunk)
+                yield chunk
+
+        if compress_downloads and "gzip" in request.headers.get("Accept-Encoding", ""):
+            return Response(
+                counted(gzipped(lines())),
+                mimetype="application/fhir+ndjson",
+                headers={"Content-Encoding": "gzip"},
+            )
+        return Response(counted(lines()), mimetype="application/fhir+ndjson")
+
+    return app
+
+
+def start_server(app, host="127.0.0.1", port=0):
+    """
+    Serve an app from a background thread
+
+    Args:
+        app (Flask): The application to serve
+        host (str): Interface to listen on
+        port (int): Port to listen on; 0 picks a free port
+
+    Returns:
+        tuple: (server with a shutdown() method, FHIR base URL)
+    """
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}/fhir"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--ndjson", default="./workshops/bulk-data/synthea_10.ndjson")
+    parser.add_argument(
+        "--patients", type=int, help="Serve the NDJSON file scaled up to this many patients"
+    )
+    parser.add_argument("--files-per-type", type=int, default=1)
+    parser.add_argument("--export-delay", type=float, default=0.0)
+    parser.add_argument("--poll-interval", type=int, default=1)
+    parser.add_argument("--auth", action="store_true", help="Require SMART access tokens")
+    parser.add_argument("--token-lifetime", type=int, default=300)
+    parser.add_argument(
+        "--compress", action="store_true", help="gzip NDJSON files for clients that accept it"
+    )
+    parser.add_argument(
+        "--reject", nargs="+", default=[], metavar="TYPE", help="Reject uploads of these types"
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        ndjson_path = args.ndjson
+        if args.patients:
+            ndjson_path = f"{work_dir}/synthea.ndjson"
+            written = synthetic_data.scale_ndjson(args.ndjson, ndjson_path, args.patients)
+            print(f"Serving {written} patients")
+
+        app = create_app(
+            ndjson_path,
+            latency=args.latency,
+            export_delay=args.export_delay,
+            poll_interval=args.poll_interval,
+            files_per_type=args.files_per_type,
+            require_auth=args.auth,
+            token_lifetime=args.token_lifetime,
+            compress_downloads=args.compress,
+            reject_types=args.reject,
+        )
+        print(f"Stub FHIR server at http://{args.host}:{args.port}/fhir")
+        app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# /// script
+# requires-python = ">=3.11"
+# dependencies = []
+# ///
+# coding: utf-8
+
+"""
+Scale the sample Synthea data up to any number of patients for benchmarking
+
+Copies of the sample patients are made by replacing every UUID in the data with
+one derived from it and the copy number, so references within a copy stay
+consistent and copies do not collide. Transaction bundles hold one patient each;
+NDJSON files are scaled by repeating every resource of the sample file.
+
+Usage:
+    uv run ./script/synthetic_data.py bundles OUTPUT_DIR --patients 10000 [--source ./fhir-data]
+    uv run ./script/synthetic_data.py ndjson OUTPUT_FILE --patients 10000
+        [--source ./workshops/bulk-data/synthea_10.ndjson]
+"""
+
+import argparse
+import math
+import re
+import uuid
+from pathlib import Path
+
+UUID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+def copy_ids(text, copy_number, cache=None):
+    """
+    Replace every UUID in text with one derived from it and copy_number
+
+    Args:
+        text (str): JSON text
+        copy_number (int): Number of the copy; copy 0 is the original
+        cache (dict): Replacements already made for this copy, reused across calls
+
+    Returns:
+        str: The text with replaced UUIDs
+    """
+    if copy_number == 0:
+        return text
+    if cache is None:
+        cache = {}
+
+    def replace(match):
+        value = match.group(0)
+        if value not in cache:
+            cache[value] = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{value}/{copy_number}"))
+        return cache[value]
+
+    return UUID_PATTERN.sub(replace, text)
+
+
+def scale_bundles(source_dir, output_dir, patients):
+    """
+    Write `patients` transaction bundles made from the bundles in source_dir
+
+    Args:
+        source_dir (str): Directory of Synthea transaction bundles (one patient each)
+        output_dir (str): Directory to write the bundles to
+        patients (int): Number of bundles to write
+
+    Returns:
+        list: Paths of the written bundles
+    """
+    sources = sorted(Path(source_dir).glob("*.json"))
+    if not sources:
+        raise ValueError(f"No JSON bundles in {source_dir}")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    paths = []
+    texts = {}
+    for i in range(patients):
+        source = sources[i % len(sources)]
+        copy_number = i // len(sources)
+        if source not in texts:
+            texts[source] = source.read_text()
+        cache = {}
+        path = output_dir / copy_ids(source.name, copy_number, cache)
+        path.write_text(copy_ids(texts[source], copy_number, cache))
+        paths.append(path)
+    return paths
+
+
+def scale_ndjson(source_path, output_path, patients):
+    """
+    Write an NDJSON file with at least `patients` patients made from source_path
+
+    Args:
+        source_path (str): NDJSON file of Synthea resources
+        output_path (str): File to write
+        patients (int): Minimum number of patients to write
+
+    Returns:
+        int: Number of patients written (a multiple of the patients in source_path)
+    """
+    with open(source_path) as file:
+        lines = file.readlines()
+    source_patients = sum('"resourceType":"Patient"' in line.replace(" ", "") for line in lines)
+    if not source_patients:
+        raise ValueError(f"No Patient resources in {source_path}")
+
+    copies = math.ceil(patients / source_patients)
+    with open(output_path, "w") as file:
+        for copy_number in range(copies):
+            cache = {}
+            file.writelines(copy_ids(line, copy_number, cache) for line in lines)
+    return copies * source_patients
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("kind", choices=["bundles", "ndjson"])
+    parser.add_argument("output")
+    parser.add_argument("--patients", type=int, default=10000)
+    parser.add_argument("--source")
+    args = parser.parse_args()
+
+    if args.kind == "bundles":
+        paths = scale_bundles(args.source or "./fhir-data", args.output, args.patients)
+        print(f"Wrote {len(paths)} bundles to {args.output}")
+    else:
+        written = scale_ndjson(
+            args.source or "./workshops/bulk-data/synthea_10.ndjson", args.output, args.patients
+        )
+        print(f"Wrote {written} patients to {args.output}")
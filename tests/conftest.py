@@ -0,0 +1,65 @@
+import json
+import logging
+import sys
+from pathlib import Path
+
+import pytest
+
+# The scripts are run directly rather than installed, and import each other by name
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "script"))
+
+import stub_fhir_server  # noqa: E402
+
+LOINC_CODE = "55232-3"
+
+
+@pytest.fixture
+def serve():
+    """Serve a stub FHIR server app in the background and return its base URL"""
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    servers = []
+
+    def start(app):
+        server, base_url = stub_fhir_server.start_server(app)
+        servers.append(server)
+        return base_url
+
+    yield start
+    for server in servers:
+        server.shutdown()
+
+
+@pytest.fixture
+def stub_server(serve):
+    """A stub FHIR server with its request counters"""
+    app = stub_fhir_server.create_app()
+    return serve(app), app.config["STUB_STATS"]
+
+
+@pytest.fixture
+def write_bundle():
+    """Write a small transaction bundle for a patient, with or without the LOINC code"""
+
+    def write(path, patient_id, loinc_code=LOINC_CODE):
+        entries = [
+            {
+                "fullUrl": f"urn:uuid:{patient_id}",
+                "resource": {"resourceType": "Patient", "id": patient_id},
+            },
+            {
+                "fullUrl": f"urn:uuid:{patient_id}-obs",
+                "resource": {
+                    "resourceType": "Observation",
+                    "id": f"{patient_id}-obs",
+                    "status": "final",
+                    "code": {"coding": [{"system": "http://loinc.org", "code": loinc_code}]},
+                    "subject": {"reference": f"urn:uuid:{patient_id}"},
+                },
+            },
+        ]
+        path.write_text(
+            json.dumps({"resourceType": "Bundle", "type": "transaction", "entry": entries})
+        )
+        return path
+
+    return write
@@ -0,0 +1,73 @@
+import load_data
+
+
+def entry(resource_type, resource_id, *references):
+    return {
+        "resource": {
+            "resourceType": resource_type,
+            "id": resource_id,
+            "link": [{"reference": reference} for reference in references],
+        },
+        "request": {"method": "PUT", "url": f"{resource_type}/{resource_id}"},
+    }
+
+
+def ids(bundle):
+    return [e["resource"]["id"] for e in bundle["entry"]]
+
+
+def test_split_transaction_orders_levels_by_references():
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            entry("Observation", "obs", "Encounter/enc", "Patient/pat"),
+            entry("Encounter", "enc", "Patient/pat"),
+            entry("Patient", "pat"),
+            entry("Device", "dev"),
+        ],
+    }
+
+    levels = load_data.split_transaction(bundle, max_entries=1)
+
+    assert [[ids(b) for b in level] for level in levels] == [
+        [["pat"], ["dev"]],
+        [["enc"]],
+        [["obs"]],
+    ]
+
+
+def test_split_transaction_keeps_cycles_whole():
+    # Patient and Group reference each other, Encounter references the cycle
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [
+            entry("Encounter", "enc", "Patient/pat"),
+            entry("Patient", "pat", "Group/grp"),
+            entry("Group", "grp", "Patient/pat"),
+        ],
+    }
+
+    levels = load_data.split_transaction(bundle, max_entries=1)
+
+    assert [[ids(b) for b in level] for level in levels] == [[["pat", "grp"]], [["enc"]]]
+
+
+def test_split_transaction_only_references_earlier_levels():
+    entries = [entry("Patient", "p0")]
+    for i in range(1, 30):
+        entries.append(entry("Patient", f"p{i}", f"Patient/p{i // 2}", f"Patient/p{i - 1}"))
+    bundle = {"resourceType": "Bundle", "type": "transaction", "entry": entries[::-1]}
+
+    levels = load_data.split_transaction(bundle, max_entries=4)
+
+    sent = set()
+    for level in levels:
+        for split in level:
+            assert len(split["entry"]) <= 4
+            for e in split["entry"]:
+                references = {r["reference"] for r in e["resource"]["link"]}
+                assert references <= sent | {f"Patient/{i}" for i in ids(split)}
+        sent |= {f"Patient/{i}" for split in level for i in ids(split)}
+    assert len(sent) == 30
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+import load_data
+
+BUNDLE_TEXT = (
+    '{"resourceType": "Bundle", "total": 1.5e10, "entry": '
+    '[{"resource": {"valueQuantity": {"value": -0.25}}}, {"resource": {"id": "a"}}], '
+    '"count": 12345, "flag": true, "next": null}'
+)
+
+
+def expected_items(text):
+    items = []
+    for key, value in json.loads(text).items():
+        if key == "entry":
+            items.extend(("entry", entry) for entry in value)
+        else:
+            items.append((key, value))
+    return items
+
+
+@pytest.mark.parametrize("text", [BUNDLE_TEXT, '{"total": 1.5e10}', "{}", ' { "a" : 123 } \n'])
+def test_iter_bundle_items_at_every_chunk_boundary(tmp_path, text):
+    path = tmp_path / "bundle.json"
+    path.write_text(text)
+
+    for chunk_size in range(1, len(text) + 2):
+        assert list(load_data.iter_bundle_items(path, chunk_size)) == expected_items(text)
+
+
+@pytest.mark.parametrize(
+    "text", ['{"a": 1}x', '{} ,', '{"a": 1.}', '{"a": 1e}', '{"a": 1', '[{"a": 1}]']
+)
+def test_iter_bundle_items_rejects_invalid_json(tmp_path, text):
+    path = tmp_path / "bundle.json"
+    path.write_text(text)
+
+    for chunk_size in (1, 2, 3, 1 << 20):
+        with pytest.raises(ValueError):
+            list(load_data.iter_bundle_items(path, chunk_size))
+
+
+def test_streamed_upload_sends_the_same_entries(tmp_path, stub_server, write_bundle):
+    base_url, stats = stub_server
+    path = write_bundle(tmp_path / "bundle.json", "p1")
+
+    load_data.process_and_upload_file(path, base_url)
+    entries = stats["entries"]
+    load_data.process_and_upload_file(path, base_url, streaming=True)
+
+    assert stats["transactions"] == 2
+    assert stats["entries"] == 2 * entries == 4
@@ -0,0 +1,81 @@
+import gzip
+
+import load_data
+
+
+def test_journal_skips_files_already_uploaded(tmp_path, stub_server, write_bundle):
+    base_url, stats = stub_server
+    bundles = tmp_path / "bundles"
+    bundles.mkdir()
+    write_bundle(bundles / "a.json", "a")
+    write_bundle(bundles / "b.json", "b")
+    write_bundle(bundles / "no_code.json", "c", loinc_code="8302-2")
+    journal_path = tmp_path / "journal.db"
+
+    successes, failures = load_data.run_fhir_upload(
+        bundles, base_url, max_files=10, journal_path=journal_path
+    )
+    assert sorted(successes) == ["a.json", "b.json"]
+    assert failures == []
+    assert stats["transactions"] == 2
+
+    # Only the changed file is uploaded again
+    write_bundle(bundles / "b.json", "b2")
+    successes, failures = load_data.run_fhir_upload(
+        bundles, base_url, max_files=10, journal_path=journal_path
+    )
+    assert successes == ["b.json"]
+    assert failures == []
+    assert stats["transactions"] == 3
+
+    # The file without the code is journaled, so later runs do not parse it again
+    journal = load_data.UploadJournal(journal_path, base_url)
+    try:
+        assert journal.is_skipped(
+            bundles / "no_code.json",
+            journal.content_hash(bundles / "no_code.json"),
+            "55232-3",
+        )
+    finally:
+        journal.close()
+
+
+def test_index_selects_malformed_files_so_they_are_reported(
+    tmp_path, stub_server, write_bundle, capsys
+):
+    base_url, stats = stub_server
+    bundles = tmp_path / "bundles"
+    bundles.mkdir()
+    write_bundle(bundles / "good.json", "good")
+    write_bundle(bundles / "no_code.json", "other", loinc_code="8302-2")
+    (bundles / "truncated.json").write_text('{"resourceType": "Bundle", "entry": [')
+    (bundles / "not_gzip.json.gz").write_bytes(b"not gzip")
+    (bundles / "list.json").write_text("[1, 2]")
+    (bundles / "compressed.json.gz").write_bytes(
+        gzip.compress(write_bundle(tmp_path / "compressed.json", "gz").read_bytes())
+    )
+    index_path = tmp_path / "index.db"
+
+    # Malformed files are reported just as they are without an index: invalid JSON
+    # is skipped like a bundle without the code, other errors count as failures
+    expected = load_data.run_fhir_upload(bundles, base_url, max_files=10)
+    assert sorted(expected[0]) == ["compressed.json.gz", "good.json"]
+    assert sorted(name for name, _ in expected[1]) == ["list.json", "not_gzip.json.gz"]
+    capsys.readouterr()
+
+    for _ in range(2):
+        assert load_data.run_fhir_upload(
+            bundles, base_url, max_files=10, index_path=index_path
+        ) == expected
+        assert "Skipping truncated.json: Invalid JSON" in capsys.readouterr().out
+
+    index = load_data.BundleCodeIndex(index_path)
+    try:
+        unindexable = index.unindexable()
+    finally:
+        index.close()
+    assert sorted(unindexable) == sorted(
+        str((bundles / name).resolve())
+        for name in ("list.json", "not_gzip.json.gz", "truncated.json")
+    )
+    assert stats["transactions"] == 6
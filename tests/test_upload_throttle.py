@@ -0,0 +1,74 @@
+import time
+
+import pytest
+from flask import jsonify
+
+import load_data
+import stub_fhir_server
+
+
+def open_circuit(throttle):
+    cooldown = None
+    while cooldown is None:
+        cooldown = throttle.record_failure()
+    return cooldown
+
+
+def test_circuit_opens_and_closes_after_a_successful_probe():
+    throttle = load_data.UploadThrottle(min_requests=2, window=4, cooldown=0.2)
+    throttle.record_success()
+    throttle.wait()
+
+    assert open_circuit(throttle) == 0.2
+    with pytest.raises(load_data.CircuitOpenError):
+        throttle.wait()
+
+    time.sleep(0.2)
+    throttle.wait()  # the probe
+    with pytest.raises(load_data.CircuitOpenError):
+        throttle.wait()
+
+    throttle.record_success()
+    throttle.wait()
+    throttle.wait()
+
+
+def test_failed_probe_doubles_the_cooldown():
+    throttle = load_data.UploadThrottle(min_requests=2, window=4, cooldown=0.1, max_delay=0.3)
+    open_circuit(throttle)
+    time.sleep(0.1)
+    throttle.wait()
+
+    assert throttle.record_failure() == 0.2
+    with pytest.raises(load_data.CircuitOpenError):
+        throttle.wait()
+    time.sleep(0.2)
+    throttle.wait()
+    assert throttle.record_failure() == 0.3
+
+
+def test_uploads_fail_fast_while_the_server_keeps_failing(
+    tmp_path, serve, write_bundle, monkeypatch
+):
+    app = stub_fhir_server.create_app()
+    requests_seen = []
+
+    @app.before_request
+    def fail():
+        requests_seen.append(1)
+        return jsonify({"resourceType": "OperationOutcome"}), 500
+
+    base_url = serve(app)
+    for i in range(4):
+        write_bundle(tmp_path / f"bundle{i}.json", f"p{i}")
+    monkeypatch.setattr(load_data, "retry_delay", lambda attempt: 0)
+
+    start = time.monotonic()
+    successes, failures = load_data.run_fhir_upload(tmp_path, base_url, max_files=4)
+
+    assert time.monotonic() - start < 10
+    assert successes == []
+    assert len(failures) == 4
+    # The first file opens the circuit; the others are failed without a request
+    assert len(requests_seen) == 5
+    assert all("Too many failed uploads" in error for _, error in failures[1:])
@@ -1,19 +1,668 @@
 import requests
 import jwt
+import asyncio
 import datetime
+import time
+import gzip
 import json
+import os
+import pickle
+import re
+import hashlib
+import sys
+import threading
+import zlib
+from bisect import bisect_right
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import quote
+from array import array
 import fhirpathpy
-from flatten_json import flatten
 from typing import Optional
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+import math
+import numpy as np
 import pandas as pd
 
 from rich import print
 
 # Status bars for long-running cels
-from tqdm.notebook import trange, tqdm
+from tqdm.auto import trange, tqdm
 
-class BulkDataFetcher:
+# Optional: needed for the on-disk DataFrame cache (cache_dir=...)
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# FHIRPath keywords and calendar duration units. Elements with these names (e.g. the
+# "div" of a narrative) can't be navigated to without delimiting them with backticks,
+# so expressions using them are left to fhirpathpy.
+FHIR_PATH_RESERVED_WORDS = (
+    'and', 'or', 'xor', 'implies', 'div', 'mod', 'in', 'contains', 'as', 'is', 'true', 'false',
+    'year', 'month', 'week', 'day', 'hour', 'minute', 'second', 'millisecond',
+    'years', 'months', 'weeks', 'days', 'hours', 'minutes', 'seconds', 'milliseconds',
+)
+_SIMPLE_FHIR_PATH_NAME = r'(?!(?:{})(?![A-Za-z0-9_]))[a-z][A-Za-z0-9_]*'.format('|'.join(FHIR_PATH_RESERVED_WORDS))
+
+# FHIRPath expressions that only navigate child elements, optionally with an index,
+# e.g. "identifier[0].value". These are evaluated with plain dict lookups.
+SIMPLE_FHIR_PATH_PATTERN = re.compile(rf'{_SIMPLE_FHIR_PATH_NAME}(\[\d+\])?(\.{_SIMPLE_FHIR_PATH_NAME}(\[\d+\])?)*')
+SIMPLE_FHIR_PATH_STEP_PATTERN = re.compile(r'([A-Za-z0-9_]+)(?:\[(\d+)\])?')
+
+
+def _compile_simple_fhir_path(expression: str):
+    steps = [(m.group(1), None if m.group(2) is None else int(m.group(2)))
+             for m in SIMPLE_FHIR_PATH_STEP_PATTERN.finditer(expression)]
+
+    def evaluate(resource):
+        # Same semantics as FHIRPath navigation: each step collects the child element
+        # from every item in the collection, flattening lists, then applies the index
+        collection = [resource]
+        for name, index in steps:
+            children = []
+            for item in collection:
+                if isinstance(item, dict):
+                    child = item.get(name)
+                    if isinstance(child, list):
+                        children.extend(c for c in child if c is not None)
+                    elif child is not None:
+                        children.append(child)
+            if index is not None:
+                children = children[index:index + 1]
+            collection = children
+        return collection
+
+    return evaluate
+
+
+@lru_cache(maxsize=1024)
+def compile_fhir_path(expression: str):
+    # Compiled expressions are cached process-wide, keyed by the expression string
+    if SIMPLE_FHIR_PATH_PATTERN.fullmatch(expression):
+        return _compile_simple_fhir_path(expression)
+    return fhirpathpy.compile(expression)
+
+
+def compile_fhir_paths(fhir_paths):
+    # fhir_paths=[
+    #    ("id", "identifier[0].value"),
+    #    ("marital_status", "maritalStatus.coding[0].code")
+    # ]
+    return [(fieldname, compile_fhir_path(expression)) for fieldname, expression in fhir_paths]
+
+
+def project_resource(resource, compiled_fhir_paths):
+    # Evaluate each compiled expression against the resource, unwrapping single values
+    filtered_resource = {}
+    for fieldname, func in compiled_fhir_paths:
+        value = func(resource)
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        filtered_resource[fieldname] = value
+    return filtered_resource
+
+
+# FHIR date and dateTime strings that typed columns (typed=True) are parsed from. A column
+# becomes datetime64 only if all its values are full dates, or all are dateTimes with a
+# time and time zone (stored in UTC); partial dates such as "2019-05" keep it a string column.
+FHIR_DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+FHIR_DATETIME_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2})')
+
+
+def _parse_fhir_dates(values):
+    # Parse distinct date strings, or return None if they are not all dates of one kind
+    # or some are out of the range of datetime64
+    if all(FHIR_DATE_PATTERN.fullmatch(value) for value in values):
+        dates = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+    elif all(FHIR_DATETIME_PATTERN.fullmatch(value) for value in values):
+        dates = pd.to_datetime(values, utc=True, errors='coerce')
+    else:
+        return None
+    return None if dates.isna().any() else dates
+
+
+class _ColumnBuilder:
+    # The values of one DataFrame column, appended row by row. While all values have the
+    # same type they go straight into a typed array: strings as codes into a table of
+    # their distinct values, numbers as doubles and booleans as bytes. Values of mixed
+    # types fall back to a list of objects. Empty lists (FHIRPath expressions that
+    # selected nothing) are missing values, unless the column holds objects anyway.
+    __slots__ = ('rows', 'kind', 'values', 'index', 'integers', 'empty_rows')
+
+    def __init__(self):
+        self.rows = array('q')
+        self.kind = None
+        self.values = None
+        self.index = None
+        self.integers = True
+        self.empty_rows = array('q')
+
+    def _start(self, kind):
+        self.kind = kind
+        if kind is str:
+            self.index = {}
+            self.values = array('q')
+        elif kind is float:
+            self.values = array('d')
+        elif kind is bool:
+            self.values = array('b')
+        else:
+            self.kind = object
+            self.values = []
+
+    def _to_objects(self):
+        if self.kind is str:
+            categories = list(self.index)
+            values = [categories[code] for code in self.values]
+        elif self.kind is float and self.integers:
+            values = [int(value) for value in self.values]
+        elif self.kind is bool:
+            values = [bool(value) for value in self.values]
+        else:
+            values = list(self.values)
+        self.kind = object
+        self.values = values
+        self.index = None
+
+    def extend(self, other, offset):
+        # Append the values of the same column built for the resources that follow,
+        # whose rows are numbered from offset
+        self.empty_rows.frombytes(_shift_rows(other.empty_rows, offset))
+        if other.kind is None:
+            return
+        if self.kind is None:
+            self._start(other.kind)
+        elif other.kind is not self.kind:
+            if self.kind is not object:
+                self._to_objects()
+            if other.kind is not object:
+                other._to_objects()
+
+        self.rows.frombytes(_shift_rows(other.rows, offset))
+        if self.kind is str:
+            # Renumber the other column's codes into this column's table of strings
+            codes = np.array([self.index.setdefault(value, len(self.index)) for value in other.index], dtype=np.int64)
+            self.values.frombytes(codes[np.frombuffer(other.values, dtype=np.int64)].tobytes())
+        else:
+            self.integers = self.integers and other.integers
+            self.values.extend(other.values)
+
+    def append(self, row, value):
+        kind = type(value)
+        if kind is list:
+            self.empty_rows.append(row)
+            return
+        if kind is int:
+            kind = float
+        if self.kind is None:
+            self._start(kind)
+        elif kind is not self.kind and self.kind is not object:
+            self._to_objects()
+
+        self.rows.append(row)
+        if self.kind is str:
+            code = self.index.get(value)
+            if code is None:
+                code = self.index[value] = len(self.index)
+            self.values.append(code)
+        else:
+            if self.kind is float and type(value) is not int:
+                self.integers = False
+            self.values.append(value)
+
+    def build(self, num_rows, typed=False):
+        # Missing values are NaN, with the same dtypes pd.DataFrame infers for numbers,
+        # booleans and strings. With typed=True strings become dates (NaT when missing)
+        # if they all are, and categoricals if values repeat (on average each value
+        # appears at least twice).
+        if self.kind is None:
+            self._start(object)
+        if self.kind is object and self.empty_rows:
+            self.rows.extend(self.empty_rows)
+            self.values.extend([] for _ in self.empty_rows)
+        rows = np.frombuffer(self.rows, dtype=np.int64)
+        complete = len(rows) == num_rows
+
+        if self.kind is str:
+            categories = list(self.index)
+            codes = np.full(num_rows, -1, dtype=np.int64)
+            codes[rows] = np.frombuffer(self.values, dtype=np.int64)
+            if typed:
+                dates = _parse_fhir_dates(categories)
+                if dates is not None:
+                    return dates.array.take(codes, allow_fill=True)
+                if len(categories) * 2 <= len(rows):
+                    return pd.Categorical.from_codes(codes, categories)
+            return np.array(categories + [np.nan], dtype=object)[codes]
+
+        if self.kind is float:
+            values = np.frombuffer(self.values, dtype=np.float64)
+            if complete:
+                return values.astype(np.int64) if self.integers else values.copy()
+            column = np.full(num_rows, np.nan)
+            column[rows] = values
+            return column
+
+        if self.kind is bool and complete:
+            return np.frombuffer(self.values, dtype=np.int8).astype(bool)
+
+        column = np.full(num_rows, np.nan, dtype=object)
+        values = [bool(value) for value in self.values] if self.kind is bool else self.values
+        for row, value in zip(rows.tolist(), values):
+            column[row] = value
+        return column
+
+
+def _shift_rows(rows, offset):
+    return (np.frombuffer(rows, dtype=np.int64) + offset).tobytes()
+
+
+def _append_leaves(value, key, row, columns):
+    # Append the leaf values of a dict or list to their columns, named the way
+    # flatten_json.flatten names them: nested keys joined with "_" and list items
+    # numbered. Empty lists and other falsy values are leaves; empty dicts are dropped,
+    # as pd.json_normalize dropped them from flatten's output.
+    items = value.items() if isinstance(value, dict) else enumerate(value)
+    for name, child in items:
+        child_key = name if key is None else f'{key}_{name}'
+        if isinstance(child, dict) or (child and isinstance(child, list)):
+            _append_leaves(child, child_key, row, columns)
+        else:
+            column = columns.get(child_key)
+            if column is None:
+                column = columns[child_key] = _ColumnBuilder()
+            column.append(row, child)
+
+
+def build_columns(resources, fhir_paths=None):
+    # Project (if FHIRPath expressions are given) and flatten resources into column
+    # builders, in one pass. Returns the builders by column name and the number of rows.
+    compiled_fhir_paths = None if fhir_paths is None else compile_fhir_paths(fhir_paths)
+    columns = {}
+    num_rows = 0
+    for resource in resources:
+        if compiled_fhir_paths is not None:
+            resource = project_resource(resource, compiled_fhir_paths)
+        _append_leaves(resource, None, num_rows, columns)
+        num_rows += 1
+    return columns, num_rows
+
+
+def merge_columns(parts):
+    # Combine the (columns, num_rows) of consecutive chunks of resources into those of all
+    # of them, with the columns in order of first appearance as if built in one pass
+    columns = {}
+    num_rows = 0
+    for part_columns, part_rows in parts:
+        for key, column in part_columns.items():
+            if key not in columns:
+                columns[key] = _ColumnBuilder()
+            columns[key].extend(column, num_rows)
+        num_rows += part_rows
+    return columns, num_rows
+
+
+def columns_to_dataframe(columns, num_rows, typed=False):
+    # Each column's dtype is chosen here, once all its values are known
+    return pd.DataFrame(
+        {key: column.build(num_rows, typed) for key, column in columns.items()},
+        index=pd.RangeIndex(num_rows),
+    )
+
+
+def build_dataframe(resources, fhir_paths=None, typed=False):
+    # Project (if FHIRPath expressions are given) and flatten resources into a DataFrame.
+    # The columns are those pd.json_normalize gives for flatten_json.flatten's output,
+    # built in one pass straight into typed arrays. With typed=True, date columns are
+    # datetime64 and string columns with repeated values categorical; group by
+    # categorical columns with observed=True to leave out combinations of categories
+    # that do not occur.
+    return columns_to_dataframe(*build_columns(resources, fhir_paths), typed)
+
+
+class DataFrameCache:
+    """
+    On-disk cache of per-resource-type DataFrames stored as Arrow IPC files, which are
+    memory-mapped when read back. Entries are keyed by the data source (an export URL
+    or a hash of the source file) together with the FHIRPath projection for the type,
+    and are only removed through invalidate(). The raw resources of an export can be
+    stored alongside as NDJSON, so they are available after a cache hit too.
+    """
+    def __init__(self, cache_dir):
+        if pa is None:
+            raise ImportError("The DataFrame cache requires pyarrow (pip install pyarrow)")
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def _digest(value):
+        return hashlib.sha256(json.dumps(value).encode('utf-8')).hexdigest()[:16]
+
+    def _path(self, source, resource_type, fhir_paths=None, typed=False):
+        projection = None if fhir_paths is None else [list(f) for f in fhir_paths]
+        return self.cache_dir / f'{self._digest(source)}-{resource_type}-{self._digest([resource_type, projection, typed])}.arrow'
+
+    def load(self, source, resource_type, fhir_paths=None, typed=False):
+        # Returns the cached DataFrame, or None if there isn't one
+        path = self._path(source, resource_type, fhir_paths, typed)
+        if not path.exists():
+            return None
+
+        with pa.memory_map(str(path), 'r') as source_file:
+            table = pa.ipc.open_file(source_file).read_all()
+
+        df = table.to_pandas()
+        json_columns = json.loads((table.schema.metadata or {}).get(b'json_columns', b'[]'))
+        for column in json_columns:
+            df[column] = [None if v is None else json.loads(v) for v in df[column]]
+        return df
+
+    def store(self, source, resource_type, fhir_paths, df, typed=False):
+        # Object columns holding lists or dicts (which Arrow would read back as numpy
+        # arrays) or values Arrow can't type, such as mixed strings and numbers, are
+        # stored as JSON
+        df = df.copy()
+        json_columns = []
+        for column in df.columns:
+            if df[column].dtype != object:
+                continue
+            needs_json = any(isinstance(v, (list, dict)) for v in df[column])
+            if not needs_json:
+                try:
+                    pa.array(df[column], from_pandas=True)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    needs_json = True
+            if needs_json:
+                df[column] = [None if _is_missing(v) else json.dumps(v) for v in df[column]]
+                json_columns.append(column)
+
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            b'json_columns': json.dumps(json_columns).encode('utf-8'),
+        })
+
+        path = self._path(source, resource_type, fhir_paths, typed)
+        tmp_path = path.with_suffix('.tmp')
+        with pa.OSFile(str(tmp_path), 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        tmp_path.replace(path)
+
+    def _resources_path(self, source, resource_type):
+        return self.cache_dir / f'{self._digest(source)}-{resource_type}.ndjson'
+
+    def load_resources(self, source, resource_type):
+        # Returns the cached raw resources as NDJSON lines (bytes), or None if there aren't any
+        path = self._resources_path(source, resource_type)
+        if not path.exists():
+            return None
+        with open(path, 'rb') as file:
+            return [line for line in file if line.strip()]
+
+    def store_resources(self, source, resource_type, resources):
+        # resources is a list of parsed resources or a CompactResourceList
+        if isinstance(resources, CompactResourceList):
+            lines = (resources.raw(i) for i in range(len(resources)))
+        else:
+            lines = (json.dumps(resource, separators=(',', ':')).encode('utf-8') for resource in resources)
+
+        path = self._resources_path(source, resource_type)
+        tmp_path = path.with_suffix('.tmp')
+        with open(tmp_path, 'wb') as file:
+            for line in lines:
+                file.write(line + b'\n')
+        tmp_path.replace(path)
+
+    def invalidate(self, source=None):
+        # Remove the cached DataFrames and resources for one source, or everything if
+        # source is None
+        prefix = '' if source is None else f'{self._digest(source)}-'
+        removed = 0
+        for extension in ('arrow', 'ndjson'):
+            for path in self.cache_dir.glob(f'{prefix}*.{extension}'):
+                path.unlink()
+                removed += 1
+        return removed
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def build_dataframes(resources_by_type, fhir_paths_by_type, workers: Optional[int] = None,
+                     cache: Optional[DataFrameCache] = None, source: Optional[str] = None,
+                     typed: bool = False):
+    # Build one DataFrame per resource type (see build_dataframe for typed). With
+    # workers > 1 the resources of each type are split into chunks that are projected
+    # and flattened in a process pool; their columns are merged in order before any
+    # dtype is chosen, so the DataFrames are the same as when built serially. With a
+    # cache, DataFrames already cached for this source and projection are read instead
+    # of rebuilt.
+    # Worker processes started with the spawn method (the default on macOS and Windows)
+    # can't use functions defined in a notebook, as with `%load helper.py`; the pool
+    # then breaks and the DataFrames are built serially instead.
+    if cache is not None:
+        dfs = {}
+        missing = {}
+        for resource_type, resources in resources_by_type.items():
+            df = cache.load(source, resource_type, fhir_paths_by_type.get(resource_type), typed)
+            if df is None:
+                missing[resource_type] = resources
+            else:
+                dfs[resource_type] = df
+
+        built = build_dataframes(missing, fhir_paths_by_type, workers, typed=typed)
+        for resource_type, df in built.items():
+            cache.store(source, resource_type, fhir_paths_by_type.get(resource_type), df, typed)
+            dfs[resource_type] = df
+
+        return {resource_type: dfs[resource_type] for resource_type in resources_by_type}
+
+    if workers is None or workers <= 1:
+        return {
+            resource_type: build_dataframe(resources, fhir_paths_by_type.get(resource_type), typed)
+            for resource_type, resources in resources_by_type.items()
+        }
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures_by_type = {}
+            for resource_type, resources in resources_by_type.items():
+                # A few chunks per worker so that uneven chunks still keep every worker busy
+                chunk_size = max(1, math.ceil(len(resources) / (workers * 4)))
+                futures_by_type[resource_type] = [
+                    executor.submit(build_columns, resources[start:start + chunk_size], fhir_paths_by_type.get(resource_type))
+                    for start in range(0, len(resources), chunk_size)
+                ]
+
+            return {
+                resource_type: columns_to_dataframe(*merge_columns(f.result() for f in futures), typed)
+                for resource_type, futures in futures_by_type.items()
+            }
+    except (BrokenProcessPool, pickle.PicklingError) as e:
+        print(f'Building DataFrames in worker processes failed ({type(e).__name__}), building them serially')
+        return build_dataframes(resources_by_type, fhir_paths_by_type, typed=typed)
+
+
+def merge_dataframe_rows(df, changed_df, positions, num_rows):
+    # Rows of df line up with the resources in a store of num_rows resources. changed_df
+    # holds rebuilt rows for the resources at the given (sorted) positions, which either
+    # replace existing rows or are appended at the end. Both must be built with
+    # typed=False, whose dtypes pd.concat combines the way a rebuild would choose them;
+    # columns that are new in changed_df are added at the end.
+    if df is None:
+        df = build_dataframe([])
+    combined = pd.concat([df, changed_df], ignore_index=True)
+    order = list(range(len(df))) + [None] * (num_rows - len(df))
+    for i, position in enumerate(positions):
+        order[position] = len(df) + i
+    return combined.iloc[order].reset_index(drop=True)
+
+
+# Bounds in seconds for the delay between export status requests
+MIN_POLL_INTERVAL = 1.0
+MAX_POLL_INTERVAL = 60.0
+
+
+def next_poll_delay(retry_after: Optional[str], previous: Optional[float] = None) -> float:
+    # Use the server's Retry-After (seconds or an HTTP date) when it sends one, however
+    # long it is; otherwise back off exponentially, up to MAX_POLL_INTERVAL, so long
+    # exports are not polled every second.
+    delay = None
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                delay = (retry_at - datetime.datetime.now(retry_at.tzinfo)).total_seconds()
+            except (TypeError, ValueError):
+                delay = None
+    if delay is None:
+        delay = MIN_POLL_INTERVAL if previous is None else min(previous * 1.5, MAX_POLL_INTERVAL)
+    return max(delay, MIN_POLL_INTERVAL)
+
+
+class TokenCache:
+    # Access tokens shared by every BulkDataFetcher in the process, keyed by
+    # (token endpoint, client_id, scope). A token is refreshed refresh_margin seconds
+    # before it expires (or halfway through its lifetime if that is shorter), and
+    # threads that need the same token while it is being refreshed wait for that one
+    # request instead of each asking the auth server for their own.
+    def __init__(self, refresh_margin: float = 60.0):
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._tokens = {}  # key -> (access token, monotonic time to refresh at)
+        self._refresh_locks = {}
+
+    def _valid_token(self, key):
+        with self._lock:
+            entry = self._tokens.get(key)
+        if entry is not None and time.monotonic() < entry[1]:
+            return entry[0]
+        return None
+
+    def get(self, key, request_token):
+        # request_token() is called to get a new token and returns (access token, expires_in)
+        token = self._valid_token(key)
+        if token is not None:
+            return token
+
+        with self._lock:
+            refresh_lock = self._refresh_locks.setdefault(key, threading.Lock())
+        with refresh_lock:
+            # Another thread may have refreshed the token while this one waited
+            token = self._valid_token(key)
+            if token is not None:
+                return token
+
+            token, expires_in = request_token()
+            refresh_in = max(expires_in - self.refresh_margin, expires_in / 2)
+            with self._lock:
+                self._tokens[key] = (token, time.monotonic() + refresh_in)
+            return token
+
+    def invalidate(self, key=None):
+        # Forget one token, or every token if no key is given
+        with self._lock:
+            if key is None:
+                self._tokens.clear()
+            else:
+                self._tokens.pop(key, None)
+
+
+# Shared by all fetchers unless one is given its own
+TOKEN_CACHE = TokenCache()
+
+
+class ResourceLookupMixin:
+    """
+    Lookup of raw resources by id. Classes using this keep raw resources in
+    self.resources_by_type and register each one with _index_resource() while
+    loading, so lookups don't have to scan the per-type lists.
+    """
+    def _reset_resource_index(self):
+        # resource type -> id -> position in self.resources_by_type[resource type]
+        self.resource_index = {}
+
+    def _index_resource(self, resource_type: str, resource_id: Optional[str], position: int):
+        if resource_id is None:
+            return
+        if resource_type not in self.resource_index:
+            self.resource_index[resource_type] = {}
+        # Keep the first occurrence, matching what a scan of the list would return
+        self.resource_index[resource_type].setdefault(resource_id, position)
+
+    def _check_resource_type(self, resource_type: str):
+        if self.resources_by_type is None:
+            print("You need to run get_dataframes() first")
+            return False
+
+        if resource_type not in self.resources_by_type:
+            print(f"{resource_type} not available. Try one of these: {', '.join(self.resources_by_type.keys())}")
+            return False
+
+        return True
+
+    def get_example_resource(self, resource_type: str, resource_id: Optional[str] = None):
+        if not self._check_resource_type(resource_type):
+            return None
+
+        if resource_id is None:
+            return self.resources_by_type[resource_type][0]
+
+        position = self.resource_index.get(resource_type, {}).get(resource_id)
+
+        if position is not None:
+            return self.resources_by_type[resource_type][position]
+
+        print(f"No {resource_type} with id={resource_id} was found.")
+        return None
+
+    def get_resources(self, resource_type: str, ids):
+        # Returns a dict of id -> resource for all the ids that were found
+        if not self._check_resource_type(resource_type):
+            return {}
+
+        index = self.resource_index.get(resource_type, {})
+        found = sorted((index[i], i) for i in set(ids) if i in index)
+        missing = len(set(ids)) - len(found)
+        if missing > 0:
+            print(f"{missing} {resource_type} id(s) were not found.")
+
+        resources = self.resources_by_type[resource_type]
+        positions = [position for position, _ in found]
+        if hasattr(resources, 'take'):
+            # Stores that decode resources on access read them together, in storage order
+            fetched = resources.take(positions)
+        else:
+            fetched = [resources[position] for position in positions]
+
+        return {resource_id: resource for (_, resource_id), resource in zip(found, fetched)}
+
+    def memory_usage(self):
+        # Bytes held by the raw resource store for each resource type. Exact for the
+        # compact and streaming stores; an estimate (sys.getsizeof of every object) for
+        # stores of parsed dicts, which is slow for large stores.
+        return {
+            resource_type: resources.memory_usage() if hasattr(resources, 'memory_usage') else _deep_getsizeof(resources)
+            for resource_type, resources in self.resources_by_type.items()
+        }
+
+
+def _deep_getsizeof(obj):
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_getsizeof(k) + _deep_getsizeof(v) for k, v in obj.items())
+    elif isinstance(obj, list):
+        size += sum(_deep_getsizeof(item) for item in obj)
+    return size
+
+
+class BulkDataFetcher(ResourceLookupMixin):
     def __init__(
         self,
         base_url: str,
@@ -21,13 +670,22 @@ class BulkDataFetcher:
         private_key: str,
         key_id: str,
         endpoint: Optional[str] = None,
-        session: Optional[str] = None
+        session: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        compact: bool = False,
+        compression: Optional[str] = None,
+        scope: str = 'system/*.read',
+        token_cache: Optional[TokenCache] = None,
+        typed: bool = False
     ):
         self.base_url = base_url
         self.client_id = client_id
         self.private_key = private_key
         self.key_id = key_id
+        self.scope = scope
 
+        # Tokens are shared with other fetchers using the same token endpoint, client and scope
+        self.token_cache = TOKEN_CACHE if token_cache is None else token_cache
         self.token = None
         self.token_expire_time = None
 
@@ -49,35 +707,54 @@ class BulkDataFetcher:
         self.resource_types = []
         self.fhir_paths = {}
 
-        # Store raw FHIR resource instances; populated as part of get_dataframes()
+        # Store raw FHIR resource instances; populated as part of get_dataframes().
+        # With compact=True they are kept as NDJSON bytes (optionally compressed) in a
+        # CompactResourceList per type instead of as parsed dicts.
         self.resources_by_type = {}
+        self._reset_resource_index()
+        self.compact = compact
+        self.compression = compression
+
+        # Optional on-disk cache of the DataFrames, keyed by export URL and FHIRPaths
+        self.dataframe_cache = DataFrameCache(cache_dir) if cache_dir else None
+
+        # With typed=True DataFrames get datetime64 and categorical columns (see build_dataframe)
+        self.typed = typed
+
+        # transactionTime of the last completed export and the DataFrames it produced,
+        # used by get_dataframes(incremental=True)
+        self.transaction_time = None
+        self.dataframes = {}
+
+        # Last X-Progress value of the export in progress ('complete' once it is done)
+        self.export_progress = None
 
 
     def get_token(self):
-        if self.token and datetime.datetime.now() < self.expire_time:
-            # the existing token is still valid so use it
-            return self.token
+        self.token = self.token_cache.get((self.token_endpoint, self.client_id, self.scope), self._request_token)
+        return self.token
 
+    def _request_token(self):
         assertion = jwt.encode({
                 'iss': self.client_id,
                 'sub': self.client_id,
                 'aud': self.token_endpoint,
                 'exp': int((datetime.datetime.now() + datetime.timedelta(minutes=5)).timestamp())
         }, self.private_key, algorithm='RS384',
-        headers={"kid": key_id})
+        headers={"kid": self.key_id})
 
         r = self.session.post(self.token_endpoint, data={
-            'scope': 'system/*.read',
+            'scope': self.scope,
             'grant_type': 'client_credentials',
             'client_assertion_type': 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer',
             'client_assertion': assertion
         })
+        r.raise_for_status()
 
         token_response = r.json()
-        self.token = token_response['access_token']
-        self.expire_time = datetime.datetime.now() + datetime.timedelta(seconds=token_response['expires_in'])
+        self.token_expire_time = datetime.datetime.now() + datetime.timedelta(seconds=token_response['expires_in'])
 
-        return self.token
+        return token_response['access_token'], token_response['expires_in']
 
     def add_resource_type(self, resource_type: str, fhir_paths = None):
         self.resource_types.append(resource_type)
@@ -86,175 +763,487 @@ class BulkDataFetcher:
             #    ("id", "identifier[0].value"),
             #    ("marital_status", "maritalStatus.coding[0].code")
             # ]
-            compiled_fhir_paths = [(f[0], fhirpathpy.compile(f[1])) for f in fhir_paths]
-            self.fhir_paths[resource_type] = compiled_fhir_paths
+            self.fhir_paths[resource_type] = list(fhir_paths)
 
-    def _invoke_request(self):
+    def _export_url(self):
         types = ','.join(self.resource_types)
-        url = f'{self.base_url}/{self.endpoint}/$export?_type={types}'
+        return f'{self.base_url}/{self.endpoint}/$export?_type={types}'
+
+    def _invoke_request(self, since: Optional[str] = None):
+        url = self._export_url()
+        if since is not None:
+            url += f'&_since={quote(since, safe="")}'
         print(f'Fetching from {url}')
         r = self.session.get(url, headers={'Authorization': f'Bearer {self.get_token()}', 'Accept': 'application/fhir+json', 'Prefer': 'respond-async'})
 
         self.check_url = r.headers['Content-Location']
         return self.check_url
 
-    def _wait_until_ready(self):
-        while True:
-            r = self.session.get(self.check_url, headers={'Authorization': f'Bearer {self.get_token()}', 'Accept': 'application/fhir+json'})
+    def _poll_status(self, previous_delay: Optional[float] = None) -> Optional[float]:
+        # Request the export status once. Returns the number of seconds to wait before
+        # polling again, or None once the export is complete and output_files is set.
+        r = self.session.get(self.check_url, headers={'Authorization': f'Bearer {self.get_token()}', 'Accept': 'application/fhir+json'})
+
+        # There are three possible options here: http://hl7.org/fhir/uv/bulkdata/export.html#bulk-data-status-request
+        # Error = 4xx or 5xx status code
+        # In-Progress = 202
+        # Complete = 200
 
-            # There are three possible options here: http://hl7.org/fhir/uv/bulkdata/export.html#bulk-data-status-request
-            # Error = 4xx or 5xx status code
-            # In-Progress = 202
-            # Complete = 200
+        if r.status_code == 200:
+            # complete
+            response = r.json()
+            self.output_files = response['output']
+            self.export_transaction_time = response.get('transactionTime')
+            self.export_progress = 'complete'
+            return None
 
-            if r.status_code == 200:
-                # complete
-                response = r.json()
-                self.output_files = response['output']
-                return self.output_files
+        elif r.status_code == 202:
+            # in progress; X-Progress is a free-text status such as "50% complete"
+            progress = r.headers.get('X-Progress')
+            if progress and progress != self.export_progress:
+                print(f'{self.endpoint} export in progress: {progress}')
+            self.export_progress = progress
+            return next_poll_delay(r.headers.get('Retry-After'), previous_delay)
 
-            elif r.status_code == 202:
-                # in progress
-                delay = r.headers['Retry-After']
+        elif r.status_code == 429:
+            # polled too often; wait as long as the server asks and poll again
+            return next_poll_delay(r.headers.get('Retry-After'), previous_delay)
 
-                sleep(int(delay))
+        else:
+            raise RuntimeError(r.text)
 
-            else:
-                raise RuntimeError(r.text)
+    def _wait_until_ready(self):
+        delay = None
+        while (delay := self._poll_status(delay)) is not None:
+            time.sleep(delay)
+        return self.output_files
+
+    async def _wait_until_ready_async(self):
+        # Like _wait_until_ready, but other exports and downloads run while this one waits
+        delay = None
+        while (delay := await asyncio.to_thread(self._poll_status, delay)) is not None:
+            await asyncio.sleep(delay)
+        return self.output_files
+
+    def _download_output_file(self, output_file):
+        # Stream the NDJSON body line by line instead of buffering the whole file as one
+        # string. Lines are parsed as they arrive unless the compact store keeps the bytes.
+        with self.session.get(output_file['url'], stream=True, headers={'Authorization': f'Bearer {self.get_token()}', 'Accept': 'application/fhir+json'}) as r:
+            r.raise_for_status()
+            lines = (line for line in r.iter_lines(chunk_size=65536) if line.strip())
+            if self.compact:
+                return list(lines)
+            return [json.loads(line) for line in lines]
+
+    def get_dataframes(self, max_workers: int = 4, workers: Optional[int] = None, incremental: bool = False):
+        # max_workers output files are downloaded concurrently; with workers > 1 the
+        # DataFrames are built in a pool of that many processes (see build_dataframes
+        # for when that falls back to building them serially).
+        # With incremental=True and a previous export, only resources changed since that
+        # export's transactionTime are requested (_since) and merged in by id.
+        if incremental and self.transaction_time is not None:
+            return self._refresh_dataframes(max_workers, workers)
+
+        if not incremental:
+            cached = self._load_cached_dataframes()
+            if cached is not None:
+                return cached
 
-    def get_dataframes(self):
         self._invoke_request()
         self._wait_until_ready()
 
-        resources_by_type = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # map() yields the files in manifest order as their downloads finish
+            downloads = executor.map(self._download_output_file, self.output_files)
+            return self._collect_export(downloads, workers, incremental)
+
+    async def get_dataframes_async(self, max_workers: int = 4, workers: Optional[int] = None):
+        # asyncio version of get_dataframes: waiting for the export does not block the event
+        # loop, so several fetchers (e.g. one per group or set of resource types) can export
+        # at the same time with gather_dataframes(). In a notebook: dfs = await fetcher.get_dataframes_async()
+        cached = self._load_cached_dataframes()
+        if cached is not None:
+            return cached
+
+        await asyncio.to_thread(self._invoke_request)
+        await self._wait_until_ready_async()
+
+        # Download the output files as soon as the manifest arrives, max_workers at a time
+        semaphore = asyncio.Semaphore(max_workers)
+
+        async def download(output_file):
+            async with semaphore:
+                return await asyncio.to_thread(self._download_output_file, output_file)
+
+        downloads = await asyncio.gather(*(download(output_file) for output_file in self.output_files))
+        return await asyncio.to_thread(self._collect_export, downloads, workers)
+
+    def _load_cached_dataframes(self):
+        if self.dataframe_cache is None:
+            return None
+        source = self._export_url()
+        cached = {
+            resource_type: self.dataframe_cache.load(source, resource_type, self.fhir_paths.get(resource_type), self.typed)
+            for resource_type in self.resource_types
+        }
+        if not cached or any(df is None for df in cached.values()):
+            return None
+        lines_by_type = {
+            resource_type: self.dataframe_cache.load_resources(source, resource_type)
+            for resource_type in self.resource_types
+        }
+        if any(lines is None for lines in lines_by_type.values()):
+            return None
+
+        # Restore the raw resources too, for reprocess_dataframes() and get_example_resource()
+        self.resources_by_type = {}
+        self._reset_resource_index()
+        for resource_type, lines in lines_by_type.items():
+            self._add_downloaded_resources(resource_type, lines if self.compact else [json.loads(line) for line in lines])
+        self.dataframes = cached
+
+        print("Using cached DataFrames; call invalidate_cache() to export again")
+        return dict(cached)
+
+    def _collect_export(self, downloads, workers: Optional[int], incremental: bool = False):
+        # Store the downloaded resources of a complete export and build its DataFrames
         self.resources_by_type = {} # Reset store of raw FHIR resources each time this is run
+        self._reset_resource_index()
 
-        for output_file in self.output_files:
-            download_url = output_file['url']
-            resource_type = output_file['type']
+        for output_file, resources in tqdm(zip(self.output_files, downloads), total=len(self.output_files)):
+            self._add_downloaded_resources(output_file['type'], resources)
 
-            r = self.session.get(download_url, headers={'Authorization': f'Bearer {get_token()}', 'Accept': 'application/fhir+json'})
+        # A full export replaces whatever the cache held for it
+        if incremental and self.dataframe_cache is not None:
+            self.dataframe_cache.invalidate(self._export_url())
 
-            ndjson = r.text.strip()
+        self.dataframes = build_dataframes(self.resources_by_type, self.fhir_paths, workers,
+                                           self.dataframe_cache, self._export_url(), self.typed)
+        if self.dataframe_cache is not None:
+            for resource_type, store in self.resources_by_type.items():
+                self.dataframe_cache.store_resources(self._export_url(), resource_type, store)
+        self.transaction_time = self.export_transaction_time
+        return dict(self.dataframes)
 
-            if resource_type not in resources_by_type:
-                resources_by_type[resource_type] = []
+    def _refresh_dataframes(self, max_workers: int, workers: Optional[int]):
+        self._invoke_request(since=self.transaction_time)
+        self._wait_until_ready()
+
+        # resource type -> positions in the store that were added or replaced
+        changed_by_type = {}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            downloads = executor.map(self._download_output_file, self.output_files)
+
+            for output_file, resources in tqdm(zip(self.output_files, downloads), total=len(self.output_files)):
+                resource_type = output_file['type']
+                changed = self._add_downloaded_resources(resource_type, resources, replace_existing=True)
+                changed_by_type.setdefault(resource_type, set()).update(changed)
+
+        for resource_type, changed in changed_by_type.items():
+            positions = sorted(changed)
+            fhir_paths = self.fhir_paths.get(resource_type)
+            store = self.resources_by_type[resource_type]
+            df = self.dataframes.get(resource_type)
+            changed_df = None
+            if not self.typed:
+                changed_df = build_dataframes({resource_type: [store[p] for p in positions]},
+                                              self.fhir_paths, workers)[resource_type]
+            if changed_df is None or (df is not None and positions[0] < len(df)
+                                      and not changed_df.columns.isin(df.columns).all()):
+                # Typed dtypes depend on every value of a column, and a column first seen in
+                # a replaced resource belongs before later columns: rebuild the DataFrame
+                self.dataframes[resource_type] = build_dataframes({resource_type: store}, self.fhir_paths,
+                                                                  workers, typed=self.typed)[resource_type]
+            else:
+                self.dataframes[resource_type] = merge_dataframe_rows(df, changed_df, positions, len(store))
+            if self.dataframe_cache is not None:
+                self.dataframe_cache.store(self._export_url(), resource_type, fhir_paths,
+                                           self.dataframes[resource_type], self.typed)
+                self.dataframe_cache.store_resources(self._export_url(), resource_type, store)
+
+        print(f"Updated {sum(len(c) for c in changed_by_type.values())} resources changed since {self.transaction_time}")
+        self.transaction_time = self.export_transaction_time
+        return dict(self.dataframes)
+
+    def _add_downloaded_resources(self, resource_type, resources, replace_existing: bool = False):
+        # resources are parsed dicts, or NDJSON lines for the compact store. Returns the
+        # positions in the store that were added or (with replace_existing, for an id that
+        # is already stored) replaced.
+        if resource_type not in self.resources_by_type:
+            if self.compact:
+                self.resources_by_type[resource_type] = CompactResourceList(self.compression)
+            else:
                 self.resources_by_type[resource_type] = []
 
-            for line in ndjson.split('\n'):
-                resource = json.loads(line)
+        store = self.resources_by_type[resource_type]
+        changed = []
 
+        for resource in resources:
+            if self.compact:
+                line = resource
+                match = RESOURCE_TYPE_PATTERN.match(line)
+                if match and match.group(2) is not None:
+                    resource_id = match.group(2).decode()
+                else:
+                    resource = json.loads(line)
+                    resource_id = resource.get('id')
+            else:
+                resource_id = resource.get('id')
+
+            position = self.resource_index.get(resource_type, {}).get(resource_id) if replace_existing else None
+            if position is None:
                 # Make raw resource instances available for future use
-                self.resources_by_type[resource_type].append(resource)
+                position = len(store)
+                self._index_resource(resource_type, resource_id, position)
+                if self.compact:
+                    store.append_bytes(line)
+                else:
+                    store.append(resource)
+            else:
+                store[position] = json.loads(line) if self.compact else resource
+            changed.append(position)
 
-                if resource_type in self.fhir_paths:
-                    fhir_paths = self.fhir_paths[resource_type]
-                    filtered_resource = {}
-                    for f in fhir_paths:
-                        fieldname = f[0]
-                        func = f[1]
-                        filtered_resource[fieldname] = func(resource)
+        return changed
 
-                        if isinstance(filtered_resource[fieldname], list) and len(filtered_resource[fieldname]) == 1:
-                            filtered_resource[fieldname] = filtered_resource[fieldname][0]
-                    resource = filtered_resource
+    def reprocess_dataframes(self, fhir_paths, workers: Optional[int] = None):
+        return BulkDataFetcher._reprocess_dataframes(self.resources_by_type, fhir_paths, workers,
+                                                     self.dataframe_cache, self._export_url(), self.typed)
 
-                resources_by_type[resource_type].append(resource)
+    def invalidate_cache(self):
+        # Remove this export's cached DataFrames so the next get_dataframes() exports again
+        if self.dataframe_cache is not None:
+            return self.dataframe_cache.invalidate(self._export_url())
+        return 0
 
-        dfs = {}
+    @classmethod
+    def _reprocess_dataframes(cls, obj_resources_by_type, user_fhir_paths, workers: Optional[int] = None,
+                              cache: Optional[DataFrameCache] = None, source: Optional[str] = None,
+                              typed: bool = False):
+        return build_dataframes(obj_resources_by_type, user_fhir_paths, workers, cache, source, typed)
 
-        for resource_type, resources in resources_by_type.items():
-            dfs[resource_type] = pd.json_normalize(list(map(lambda r: flatten(r), resources)))
 
-        return dfs
+async def gather_dataframes(*fetchers, max_workers: int = 4, workers: Optional[int] = None):
+    # Run the exports of several BulkDataFetchers at the same time, e.g. one per group:
+    # group_a_dfs, group_b_dfs = await gather_dataframes(fetcher_a, fetcher_b)
+    return await asyncio.gather(*(fetcher.get_dataframes_async(max_workers, workers) for fetcher in fetchers))
 
-    def get_example_resource(self, resource_type: str, resource_id: Optional[str] = None):
-        if self.resources_by_type is None:
-            print("You need to run get_dataframes() first")
-            return None
 
-        if resource_type not in self.resources_by_type:
-            print(f"{resource_type} not available. Try one of these: {', '.join(self.resources_by_type.keys())}")
-            return None
+# Matches the resourceType (and id, if it comes next) when they are the first keys on an
+# NDJSON line, as in Synthea exports, so they can be found without parsing the resource
+RESOURCE_TYPE_PATTERN = re.compile(
+    rb'\s*\{\s*"resourceType"\s*:\s*"([A-Za-z]+)"(?:\s*,\s*"id"\s*:\s*"([^"\\]*)")?')
 
-        if resource_id is None:
-            return self.resources_by_type[resource_type][0]
 
-        resource = [r for r in self.resources_by_type[resource_type] if r['id'] == resource_id]
+def is_gzipped(ndjson_file_path):
+    return str(ndjson_file_path).endswith('.gz')
 
-        if len(resource) > 0:
-            return resource[0]
 
-        print(f"No {resource_type} with id={resource_id} was found.")
-        return None
+def read_ndjson_lines(ndjson_file_path, digest=None):
+    # Yields (byte offset, line) for each non-empty line, reading the file once.
+    # .gz files are decompressed as they are read; offsets are then positions in the
+    # decompressed data. Progress is tracked in (compressed) file bytes so the lines
+    # don't have to be counted up front.
+    # If a hashlib digest is given, it is updated with the (decompressed) contents.
+    gzipped = is_gzipped(ndjson_file_path)
+    with (gzip.open if gzipped else open)(ndjson_file_path, 'rb') as file, \
+            tqdm(total=os.path.getsize(ndjson_file_path), unit='B', unit_scale=True) as progress:
+        offset = 0
+        for line in file:
+            if digest is not None:
+                digest.update(line)
+            if line.strip():
+                yield offset, line
+            offset += len(line)
+            progress.update((file.fileobj.tell() if gzipped else offset) - progress.n)
 
-    def reprocess_dataframes(self, fhir_paths):
-        return BulkDataFetcher._reprocess_dataframes(self.resources_by_type, fhir_paths)
 
-    @classmethod
-    def _reprocess_dataframes(cls, obj_resources_by_type, user_fhir_paths):
-        parsed_resources_by_type = defaultdict(list)
-
-        for this_resource_type in obj_resources_by_type.keys():
-            if this_resource_type in user_fhir_paths:
-                user_fhir_paths[this_resource_type] = [(f[0], fhirpathpy.compile(f[1])) for f in user_fhir_paths[this_resource_type]]
-            for resource in obj_resources_by_type[this_resource_type]:
-                if this_resource_type in user_fhir_paths:
-                    filtered_resource = {}
-                    for f in user_fhir_paths[this_resource_type]:
-                        fieldname = f[0]
-                        func = f[1]
-                        filtered_resource[fieldname] = func(resource)
-
-                        if isinstance(filtered_resource[fieldname], list) and len(filtered_resource[fieldname]) == 1:
-                            filtered_resource[fieldname] = filtered_resource[fieldname][0]
-                    parsed_resources_by_type[this_resource_type].append(filtered_resource)
-                else:
-                    parsed_resources_by_type[this_resource_type].append(resource)
+class NDJSONResourceList:
+    """
+    Read-only list of the resources found at the given byte offsets of an NDJSON file.
+    Only the offsets are kept in memory; resources are parsed each time they are accessed.
+    """
+    def __init__(self, ndjson_file_path, offsets):
+        self.ndjson_file_path = ndjson_file_path
+        self.offsets = offsets
 
-        dfs = {}
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return NDJSONResourceList(self.ndjson_file_path, self.offsets[index])
+
+        with open(self.ndjson_file_path, 'rb') as file:
+            file.seek(self.offsets[index])
+            return json.loads(file.readline())
+
+    def __iter__(self):
+        with open(self.ndjson_file_path, 'rb') as file:
+            for offset in self.offsets:
+                file.seek(offset)
+                yield json.loads(file.readline())
+
+    def take(self, indices):
+        # Parse the resources at several positions using one open file
+        with open(self.ndjson_file_path, 'rb') as file:
+            resources = []
+            for index in indices:
+                file.seek(self.offsets[index])
+                resources.append(json.loads(file.readline()))
+            return resources
+
+    def memory_usage(self):
+        return sys.getsizeof(self.offsets)
+
+
+class CompactResourceList:
+    """
+    List of resources kept as their serialized JSON bytes in a contiguous buffer, with
+    arrays of start offsets and lengths; resources are decoded on access. With
+    compression='zlib' the buffer is cut into blocks of about block_size bytes that are
+    compressed individually, and the most recently used block is kept decompressed.
+    """
+    def __init__(self, compression: Optional[str] = None, block_size: int = 1 << 18):
+        if compression not in (None, 'zlib'):
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.compression = compression
+        self.block_size = block_size
+
+        self._starts = array('q')
+        self._lengths = array('q')
+        # Uncompressed: all the data. Compressed: the block currently being filled.
+        self._buffer = bytearray()
+        self._blocks = []
+        self._block_starts = array('q')
+        self._size = 0
+        self._cached_block = (None, None)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cached_block'] = (None, None)
+        return state
+
+    def _write(self, data: bytes):
+        start = self._size
+        self._buffer += data
+        self._size += len(data)
+        if self.compression and len(self._buffer) >= self.block_size:
+            self._block_starts.append(self._size - len(self._buffer))
+            self._blocks.append(zlib.compress(bytes(self._buffer)))
+            self._buffer = bytearray()
+        return start
+
+    def append_bytes(self, data: bytes):
+        # Add a resource from its serialized JSON, e.g. an NDJSON line
+        data = data.rstrip(b'\r\n')
+        self._starts.append(self._write(data))
+        self._lengths.append(len(data))
+
+    def append(self, resource):
+        self.append_bytes(json.dumps(resource, separators=(',', ':')).encode('utf-8'))
 
-        for t, res in parsed_resources_by_type.items():
-            dfs[t] = pd.json_normalize(list(map(lambda r: flatten(r), res)))
+    def __setitem__(self, index, resource):
+        # The new version is written at the end; the old bytes are not reclaimed
+        data = json.dumps(resource, separators=(',', ':')).encode('utf-8')
+        self._starts[index] = self._write(data)
+        self._lengths[index] = len(data)
 
-        return dfs
+    def __len__(self):
+        return len(self._starts)
 
+    def raw(self, index):
+        start = self._starts[index]
+        end = start + self._lengths[index]
+        buffer_start = self._size - len(self._buffer)
+        if start >= buffer_start:
+            return bytes(self._buffer[start - buffer_start:end - buffer_start])
+
+        block_number = bisect_right(self._block_starts, start) - 1
+        if self._cached_block[0] != block_number:
+            self._cached_block = (block_number, zlib.decompress(self._blocks[block_number]))
+        block_start = self._block_starts[block_number]
+        return self._cached_block[1][start - block_start:end - block_start]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            subset = CompactResourceList(self.compression, self.block_size)
+            for i in range(*index.indices(len(self))):
+                subset.append_bytes(self.raw(i))
+            return subset
+        return json.loads(self.raw(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def take(self, indices):
+        return [self[index] for index in indices]
+
+    def memory_usage(self):
+        return (sys.getsizeof(self._buffer) + sum(sys.getsizeof(block) for block in self._blocks)
+                + sys.getsizeof(self._starts) + sys.getsizeof(self._lengths) + sys.getsizeof(self._block_starts))
+
+
+class SyntheaDataFetcher(ResourceLookupMixin):
+    def __init__(self, ndjson_file_path, streaming: bool = False, cache_dir: Optional[str] = None,
+                 typed: bool = False):
+        # With streaming=True only a byte offset index per resource type is built, and
+        # resources are parsed lazily when iterated over or looked up. Use this for
+        # exports that don't fit in memory.
+        # With cache_dir, DataFrames are cached on disk keyed by a hash of the file
+        # contents and the FHIRPaths; combine with streaming=True to skip most parsing.
+        # .ndjson.gz files are decompressed while reading, except with streaming=True,
+        # which needs to seek in the file.
+        # With typed=True DataFrames get datetime64 and categorical columns (see build_dataframe).
+        if streaming and is_gzipped(ndjson_file_path):
+            raise ValueError("streaming=True needs an uncompressed NDJSON file")
 
-class SyntheaDataFetcher:
-    def __init__(self, ndjson_file_path):
         self.resources_by_type = {}
+        self._reset_resource_index()
 
-        num_lines = sum(1 for line in open(ndjson_file_path,'r'))
-        with open(ndjson_file_path, 'r') as file:
-            for line in tqdm(file, total=num_lines):
+        self.dataframe_cache = DataFrameCache(cache_dir) if cache_dir else None
+        self.typed = typed
+        digest = hashlib.sha256() if cache_dir else None
+
+        if streaming:
+            offsets_by_type = {}
+            for offset, line in read_ndjson_lines(ndjson_file_path, digest):
+                match = RESOURCE_TYPE_PATTERN.match(line)
+                if match and match.group(2) is not None:
+                    this_resource_type = match.group(1).decode()
+                    resource_id = match.group(2).decode()
+                else:
+                    json_obj = json.loads(line)
+                    this_resource_type = json_obj['resourceType']
+                    resource_id = json_obj.get('id')
+                if this_resource_type not in offsets_by_type:
+                    offsets_by_type[this_resource_type] = array('q')
+                self._index_resource(this_resource_type, resource_id, len(offsets_by_type[this_resource_type]))
+                offsets_by_type[this_resource_type].append(offset)
+
+            for this_resource_type, offsets in offsets_by_type.items():
+                self.resources_by_type[this_resource_type] = NDJSONResourceList(ndjson_file_path, offsets)
+        else:
+            for offset, line in read_ndjson_lines(ndjson_file_path, digest):
                 json_obj = json.loads(line)
                 this_resource_type = json_obj['resourceType']
                 if this_resource_type not in self.resources_by_type:
                     self.resources_by_type[this_resource_type] = []
+                self._index_resource(this_resource_type, json_obj.get('id'), len(self.resources_by_type[this_resource_type]))
                 self.resources_by_type[this_resource_type].append(json_obj)
 
+        self.source_hash = None if digest is None else digest.hexdigest()
+
         print("Resources available: ")
         print('\n'.join(['- '+ x for x in self.resources_by_type.keys()]))
 
-    def get_example_resource(self, resource_type: str, resource_id: Optional[str] = None):
-        if self.resources_by_type is None:
-            print("You need to run get_dataframes() first")
-            return None
-
-        if resource_type not in self.resources_by_type:
-            print(f"{resource_type} not available. Try one of these: {', '.join(self.resources_by_type.keys())}")
-            return None
-
-        if resource_id is None:
-            return self.resources_by_type[resource_type][0]
-
-        resource = [r for r in self.resources_by_type[resource_type] if r['id'] == resource_id]
-
-        if len(resource) > 0:
-            return resource[0]
-
-        print(f"No {resource_type} with id={resource_id} was found.")
-        return None
+    def reprocess_dataframes(self, user_fhir_paths, workers: Optional[int] = None):
+        return BulkDataFetcher._reprocess_dataframes(self.resources_by_type, user_fhir_paths, workers,
+                                                     self.dataframe_cache, self.source_hash, self.typed)
 
-    def reprocess_dataframes(self, user_fhir_paths):
-        return BulkDataFetcher._reprocess_dataframes(self.resources_by_type, user_fhir_paths)
+    def invalidate_cache(self):
+        # Remove the cached DataFrames for this file
+        if self.dataframe_cache is not None:
+            return self.dataframe_cache.invalidate(self.source_hash)
+        return 0